@@ -40,6 +40,10 @@ class BiomPanel(wx.Panel):
                          'count_table': None,
                          'tax_table': None,
                          'obs': True,
+                         'bulk': False,
+                         'cache': False,
+                         'workers': 1,
+                         'pool_size': 100,
                          'sample_meta': None,
                          'taxon_meta': None,
                          'username': 'neo4j',
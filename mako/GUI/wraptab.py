@@ -69,7 +69,8 @@ class WrapPanel(wx.Panel):
                          'stats': 'bonferroni',
                          'store_config': False,
                          'subset': 0.8,
-                         'username': 'neo4j'}
+                         'username': 'neo4j',
+                         'workers': 1}
         btnsize = (300, -1)
         boxsize = (700, 400)
 
@@ -240,9 +240,44 @@ parse_neo4biom.add_argument('-del', '--delete',
 parse_neo4biom.add_argument('-o', '--observations',
                             dest='obs',
                             required=False,
-                            help='If flagged, BIOM file counts are not uploaded. ',
+                            help='If flagged, BIOM file counts are not uploaded. '
+                                 'Uploading counts requires Neo4j 4.4 or later. ',
                             action='store_false',
                             default=True)
+parse_neo4biom.add_argument('-bulk', '--bulk',
+                            dest='bulk',
+                            required=False,
+                            help='If flagged, BIOM files are written to CSV files for neo4j-admin import '
+                                 'instead of being uploaded. Use this for initial loads of large files. '
+                                 'The import needs an empty database, so only a single file can be given. ',
+                            action='store_true',
+                            default=False)
+parse_neo4biom.add_argument('-cache', '--cache',
+                            dest='cache',
+                            required=False,
+                            help='If flagged, parsed BIOM files are cached in ~/.cache/mako/biom, '
+                                 'so uploading the same file again is faster. ',
+                            action='store_true',
+                            default=False)
+parse_neo4biom.add_argument('-workers', '--workers',
+                            dest='workers',
+                            required=False,
+                            help='Number of files to upload in parallel. '
+                                 'Before uploading in parallel, the indices on the names of Experiment, '
+                                 'Property, Specimen, Taxon and taxonomy nodes are permanently replaced '
+                                 'by unique constraints, so shared taxa are not duplicated. '
+                                 'If a constraint cannot be created, for example because of duplicate names, '
+                                 'its index is kept and files are uploaded one at a time. ',
+                            type=int,
+                            default=1)
+parse_neo4biom.add_argument('-pool', '--pool_size',
+                            dest='pool_size',
+                            required=False,
+                            help='Maximum number of connections to the Neo4j database. '
+                                 'Every worker holds one connection at a time, '
+                                 'so this should be at least as large as the number of workers. ',
+                            type=int,
+                            default=100)
 parse_neo4biom.set_defaults(neo4biom=True)
 
 parse_io = subparsers.add_parser('io', description='Read/write operations to disk, Cytoscape and Neo4j.',
@@ -449,6 +484,12 @@ parse_manta.add_argument('-b', '--binary',
                          required=False,
                          default=False,
                          help='If flagged, edge weights are converted to 1 and -1. ')
+parse_manta.add_argument('-workers', '--workers',
+                         dest='workers',
+                         required=False,
+                         help='Number of networks to cluster in parallel. ',
+                         type=int,
+                         default=1)
 parse_manta.set_defaults(manta=True)
 
 parse_anuran = subparsers.add_parser('anuran', description='Analyse groups of networks in the database.',
@@ -233,17 +233,15 @@ class BaseDriver(ParentDriver):
         :return: Success message or log of ontology violations
         """
         error = False
-        for prop in self.properties:
-            if len(self.properties[prop]) > 0:
-                query = "MATCH (n)-[r:" + prop.upper() + "]-() WHERE NOT "
-                for i in range(len(self.properties[prop])):
-                    if i != 0:
-                        query += " AND NOT "
-                    query += ("n:" + self.properties[prop][i])
-                query += " RETURN count(n) as count"
-            count = self.query(query)
-            if count[0]['count'] != 0:
-                logger.error("Relationship " + prop + " is connected to nodes not specified in database schema!")
+        # all relationship types are checked in a single pass over the relationships
+        rules = {prop.upper(): self.properties[prop] for prop in self.properties
+                 if len(self.properties[prop]) > 0}
+        with self._driver.session() as session:
+            counts = session.read_transaction(self._count_violations, rules)
+        for count in counts:
+            if count['count'] != 0:
+                logger.error("Relationship " + count['rel'].lower() +
+                             " is connected to nodes not specified in database schema!")
                 error = True
         if not error:
             logger.info("No forbidden relationship connections.")
@@ -268,6 +266,20 @@ class BaseDriver(ParentDriver):
                 output = session.write_transaction(self._query, constraint_name)
                 output = session.write_transaction(self._query, constraint_id)
 
+    @staticmethod
+    def _count_violations(tx, rules):
+        """
+        Counts, per relationship type, the nodes connected by
+        that relationship that have none of the allowed labels.
+        :param tx: Neo4j transaction
+        :param rules: Dictionary of relationship types with lists of allowed node labels
+        :return: List of dictionaries with relationship type and count
+        """
+        query = "MATCH (n)-[r]-() WHERE type(r) IN keys($rules) " \
+                "AND NONE(label IN labels(n) WHERE label IN $rules[type(r)]) " \
+                "RETURN type(r) as rel, count(n) as count"
+        return tx.run(query, rules=rules).data()
+
     @staticmethod
     def _delete_all(tx):
         """
@@ -18,7 +18,8 @@ __license__ = 'Apache 2.0'
 
 from uuid import uuid4  # generates unique IDs for edges + observations
 import networkx as nx
-from mako.scripts.utils import ParentDriver, _get_unique, _create_logger, _read_config, _get_path
+from mako.scripts.utils import ParentDriver, _get_unique, _create_logger, _read_config, _get_path, \
+    MakoDriverError
 import pandas as pd
 import logging
 import sys
@@ -61,6 +62,9 @@ def start_io(inputs):
     except KeyError:
         logger.error("Login information not specified in arguments.", exc_info=True)
         sys.exit()
+    except MakoDriverError:
+        logger.exception("Unable to start driver.")
+        sys.exit()
     # Only process network files if present
     if inputs['networks'] and not inputs['delete'] and not inputs['write'] and not inputs['cyto']:
         try:
@@ -132,9 +136,7 @@ def read_networks(files, filepath, driver):
             network = _read_network_extension(checked_path)
         else:
             sys.exit()
-        name = files.split('/')[-1]
-        name = name.split('\\')[-1]
-        name = name.split(".")[0]
+        name = os.path.splitext(os.path.basename(files))[0]
         if network:
             driver.convert_networkx(network=network, network_id=name)
 
@@ -487,20 +489,18 @@ class IoDriver(ParentDriver):
                 sys.exit()
             elif verbose:
                 logger.info(str(found_nodes) + ' out of ' + str(len(matches)) + ' values found in database.')
-        found_nodes = [x for x in nodes if matches[str(x['source'])]]
-        node_query_dict = list()
-        for node in found_nodes:
-            single_query = {'source': str(node['source']),
-                            'target': str(node['target']),
-                            'name': name}
-            for property in node:
-                if property not in ['source', 'target']:
-                    single_query[property] = node[property]
-            node_query_dict.append(single_query)
-        with self._driver.session() as session:
+            found_nodes = [x for x in nodes if matches[str(x['source'])]]
+            node_query_dict = list()
+            for node in found_nodes:
+                single_query = {'source': str(node['source']),
+                                'target': str(node['target']),
+                                'name': name}
+                for property in node:
+                    if property not in ['source', 'target']:
+                        single_query[property] = node[property]
+                node_query_dict.append(single_query)
             session.write_transaction(self._create_property,
                                       node_query_dict, sourcetype=label)
-        with self._driver.session() as session:
             session.write_transaction(self._connect_property,
                                       node_query_dict, sourcetype=label)
 
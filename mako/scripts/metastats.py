@@ -15,7 +15,8 @@ __license__ = 'Apache 2.0'
 import sys
 from uuid import uuid4
 import numpy as np
-from mako.scripts.utils import ParentDriver, _get_unique, _create_logger, _read_config
+from mako.scripts.utils import ParentDriver, _get_unique, _create_logger, _read_config, \
+    MakoDriverError
 import logging.handlers
 from scipy.stats import hypergeom, spearmanr
 
@@ -53,6 +54,9 @@ def start_metastats(inputs):
     except KeyError:
         logger.error("Login information not specified in arguments.", exc_info=True)
         exit()
+    except MakoDriverError:
+        logger.exception("Unable to start driver.")
+        exit()
     if inputs['agglom']:
         tax_list = ['Species', 'Genus', 'Family', 'Order', 'Class', 'Phylum', 'Kingdom']
         level_id = tax_list.index(inputs['agglom'].capitalize())
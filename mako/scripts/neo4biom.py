@@ -18,19 +18,23 @@ __status__ = 'Development'
 __license__ = 'Apache 2.0'
 
 import os
+import io
 import sys
-import numpy as np
+import pickle
+import hashlib
 import pandas as pd
-from biom import load_table
+from biom import load_table, Table
+from neo4j.exceptions import TransientError
 import zipfile
 import yaml
 import tempfile
 import shutil
 from pathlib import Path
-from biom.parse import MetadataMap
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import logging.handlers
 from mako.scripts.utils import ParentDriver, _create_logger, \
-    _read_config, _get_path, _run_subbatch
+    _read_config, _get_path, _run_subbatch, _create_name_indices, MakoDriverError
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -48,6 +52,64 @@ logger.addHandler(sh)
 # other handlers append to the file
 
 
+_tax_levels = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
+
+# parsed BIOM tables are cached here if the cache option is set
+_biom_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'mako', 'biom')
+
+# node labels cannot be parameterized in Cypher,
+# so a FOREACH clause that only runs for matching records
+# is included for each taxonomic level.
+# This way, a single query (and query plan) covers all levels.
+_create_taxonomy_query = "WITH $batch as batch " \
+                         "UNWIND batch as record " + \
+                         " ".join(["FOREACH (x IN CASE WHEN record.level = '" + level +
+                                   "' THEN [1] ELSE [] END | "
+                                   "MERGE (a:" + level + " {name: record.label}))"
+                                   for level in _tax_levels])
+
+_connect_taxonomy_query = "WITH $batch as batch " \
+                          "UNWIND batch as record " + \
+                          " ".join(["FOREACH (x IN CASE WHEN record.level = '" + _tax_levels[i] +
+                                    "' THEN [1] ELSE [] END | "
+                                    "MERGE (a:" + _tax_levels[i] + " {name: record.label1}) "
+                                    "MERGE (b:" + _tax_levels[i-1] + " {name: record.label2}) "
+                                    "MERGE (a)-[r:MEMBER_OF]->(b))"
+                                    for i in range(1, len(_tax_levels))])
+
+_add_taxonomy_query = "WITH $batch as batch " \
+                      "UNWIND batch as record " \
+                      "MATCH (a:Taxon {name: record.taxon}) " + \
+                      " ".join(["FOREACH (x IN CASE WHEN record.level = '" + level +
+                                "' THEN [1] ELSE [] END | "
+                                "MERGE (b:" + level + " {name: record.label}) "
+                                "MERGE (a)-[r:MEMBER_OF]->(b))"
+                                for level in _tax_levels])
+
+
+@lru_cache(maxsize=None)
+def _connect_property_query(sourcetype, rel_keys):
+    """
+    Builds the query that connects source nodes to property nodes.
+    Queries are cached, so each combination of source label
+    and relationship properties is only built once.
+    :param sourcetype: Label of source nodes
+    :param rel_keys: Tuple of record keys that are set as relationship properties
+    :return: Cypher query
+    """
+    if len(sourcetype) > 0:
+        sourcetype = ':' + sourcetype
+    rel = ""
+    if len(rel_keys) > 0:
+        rel = " {" + ", ".join([key + ": record." + key for key in rel_keys]) + "}"
+    query = "WITH $batch as batch " \
+            "UNWIND batch as record " \
+            "MATCH (a" + sourcetype + " {name:record.source}), (b:Property {name:record.name}) " \
+            "MERGE (a)-[r:QUALITY_OF" + rel + "]->(b) " \
+            "RETURN type(r)"
+    return query
+
+
 def start_biom(inputs):
     """
     Takes all input and returns a dictionary of biom files.
@@ -65,41 +127,70 @@ def start_biom(inputs):
         config = _read_config(inputs)
     else:
         config = inputs
+    # options added in later versions are optional,
+    # so older callers and GUI settings still work
+    pool_size = inputs.get('pool_size', 100)
+    bulk = inputs.get('bulk', False)
+    workers = inputs.get('workers', 1)
+    cache = inputs.get('cache', False)
     try:
         driver = Biom2Neo(uri=config['address'],
                           user=config['username'],
                           password=config['password'],
                           filepath=inputs['fp'],
-                          encrypted=inputs['encryption'])
+                          encrypted=inputs['encryption'],
+                          pool_size=pool_size)
     except KeyError:
         logger.error("Login information not specified in arguments.", exc_info=True)
         sys.exit()
+    except MakoDriverError:
+        logger.exception("Unable to start driver.")
+        sys.exit()
     check_arguments(inputs)
-    # Only process count files if present
+    if workers > 1 and not driver.create_constraints():
+        # without unique constraints, parallel MERGE queries can duplicate shared nodes
+        logger.warning("Could not create unique constraints on node names, "
+                       "so files are uploaded one at a time.")
+        workers = 1
+    # BIOM files, Qiime 2 artifacts and tab-delimited tables share a single pool,
+    # so there are never more uploads running than workers
+    uploads = list()
     if inputs['biom_file'] is not None:
-        try:
-            for x in inputs['biom_file']:
-                # first check if it is a file or path
-                logger.info('Working on ' + x + '...')
-                read_bioms(files=x, filepath=inputs['fp'], driver=driver, obs=inputs['obs'])
-        except Exception:
-            logger.error("Failed to import BIOM files.", exc_info=True)
+        for x in inputs['biom_file']:
+            for y in _list_files(x, inputs['fp'], 'BIOM'):
+                uploads.append((y, "Failed to import BIOM files.", _upload_biom_file,
+                                (y, inputs['fp'], driver, inputs['obs'], bulk, cache)))
     if inputs['qza'] is not None:
-        try:
-            for x in inputs['qza']:
-                # first check if it is a file or path
-                logger.info('Working on ' + x + '...')
-                read_qiime2(files=x, filepath=inputs['fp'], driver=driver)
-        except Exception:
-            logger.error("Failed to import Qiime 2 artifact.", exc_info=True)
+        for x in inputs['qza']:
+            for y in _list_files(x, inputs['fp'], 'qza'):
+                uploads.append((y, "Failed to import Qiime 2 artifact.", _upload_qiime2, (y, driver)))
     if inputs['count_table'] is not None:
+        def _read_tab_files(i):
+            name, biomtab = read_tabs(inputs=inputs, i=i)
+            _upload_biom(biomtab, name, filepath=inputs['fp'], driver=driver,
+                         obs=inputs['obs'], bulk=bulk)
+        for i in range(len(inputs['count_table'])):
+            uploads.append((inputs['count_table'][i], "Failed to combine input files.",
+                            _read_tab_files, (i,)))
+    if bulk and len(uploads) > 1:
+        # every neo4j-admin import command needs an empty database,
+        # so only a single file can be imported this way
+        logger.error("Only a single file can be written for neo4j-admin import. "
+                     "Run mako once per file, or upload the files without --bulk.")
+        sys.exit(1)
+
+    def _run_upload(upload):
+        name, message, func, args = upload
+        logger.info('Working on ' + name + '...')
         try:
-            for i in range(len(inputs['count_table'])):
-                name, biomtab = read_tabs(inputs=inputs, i=i)
-                driver.convert_biom(biomfile=biomtab, exp_id=name, obs=inputs['obs'])
+            func(*args)
         except Exception:
-            logger.warning("Failed to combine input files.", exc_info=True)
-    elif inputs['tax_table'] is not None:
+            logger.error(message, exc_info=True)
+    # the Neo4j driver is thread-safe,
+    # each thread gets its own session from the connection pool
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(_run_upload, uploads))
+    if inputs['count_table'] is None and inputs['tax_table'] is not None:
         try:
             for x in inputs['tax_table']:
                 logger.info('Working on uploading separate taxonomy table ' + x + '...')
@@ -130,17 +221,17 @@ def check_arguments(inputs):
         logger.info('Tab-delimited OTU table(s) to process: \n' + ", \n".join(inputs['count_table']))
     if inputs['tax_table'] is not None:
         logger.info('Tab-delimited taxonomy table(s) to process: \n' + ", \n".join(inputs['tax_table']))
-    if inputs['sample_meta'] is not None:
-        if len(inputs['count_table']) is not len(inputs['sample_data']):
-            logger.error("Add a sample data table for every OTU table!", exc_info=True)
-            sys.exit()
-    if inputs['taxon_meta'] is not None:
-        if len(inputs['count_table']) is not len(inputs['taxon_meta']):
-            logger.error("Add a metadata table for every OTU table!", exc_info=True)
-            sys.exit()
+    if inputs['count_table'] is not None:
+        paired_tables = {'tax_table': 'taxonomy table',
+                         'sample_meta': 'sample data table',
+                         'taxon_meta': 'metadata table'}
+        for key in paired_tables:
+            if inputs[key] is not None and len(inputs[key]) != len(inputs['count_table']):
+                logger.error("Add a " + paired_tables[key] + " for every OTU table!")
+                sys.exit(1)
 
 
-def read_bioms(files, filepath, driver, obs=True):
+def read_bioms(files, filepath, driver, obs=True, bulk=False, cache=False):
     """
     Reads BIOM files from a list and calls the driver for each file.
     4 ways of giving the filepaths are possible:
@@ -153,24 +244,142 @@ def read_bioms(files, filepath, driver, obs=True):
     :param filepath: Filepath where files are stored / written
     :param obs: If false, counts aren't uploaded.
     :param driver: Biom2Neo driver instance
+    :param bulk: If true, files are written to CSV files for neo4j-admin import.
+    :param cache: If true, parsed BIOM files are cached.
     :return:
     """
+    for y in _list_files(files, filepath, 'BIOM'):
+        _upload_biom_file(y, filepath, driver, obs=obs, bulk=bulk, cache=cache)
+
+
+def _list_files(files, filepath, filetype):
+    """
+    Returns the complete filepaths of all files in a directory,
+    or the complete filepath of a single file.
+    :param files: Filename or file directory
+    :param filepath: Filepath where files are stored / written
+    :param filetype: Type of file, used in the error message
+    :return: List of complete filepaths
+    """
     if os.path.isdir(files):
-        for y in os.listdir(files):
-            biomtab = load_table(files + '/' + y)
-            name = y.split(".")[0]
-            driver.convert_biom(biomfile=biomtab, exp_id=name)
+        return [files + '/' + y for y in os.listdir(files)]
+    checked_path = _get_path(path=files, default=filepath)
+    if not checked_path:
+        logger.error("Unable to read " + filetype + " file, path is incorrect.")
+        sys.exit()
+    return [checked_path]
+
+
+def _upload_biom_file(biom_fp, filepath, driver, obs=True, bulk=False, cache=False):
+    """
+    Reads a single BIOM file and uploads it to the database.
+    The filename without extension is used as name of the Experiment node.
+    :param biom_fp: Complete filepath to BIOM file
+    :param filepath: Filepath where files are stored / written
+    :param driver: Biom2Neo driver instance
+    :param obs: If false, counts aren't uploaded.
+    :param bulk: If true, files are written to CSV files for neo4j-admin import.
+    :param cache: If true, parsed BIOM files are cached.
+    :return:
+    """
+    biomtab = _cached_load_table(biom_fp, cache=cache)
+    name = os.path.splitext(os.path.basename(biom_fp))[0]
+    _upload_biom(biomtab, name, filepath=filepath, driver=driver, obs=obs, bulk=bulk)
+
+
+def _cached_load_table(filepath, cache=False, cache_dir=_biom_cache_dir):
+    """
+    Loads a BIOM file, using a pickled copy of the parsed table if caching is enabled.
+    There is a single pickle for each BIOM file, named after its absolute filepath.
+    Tables with metadata cannot be pickled, so the pickle contains
+    the matrix, IDs and metadata of the table instead.
+    The pickle also stores the modification time and size of the BIOM file,
+    so a changed file is parsed again and its pickle is replaced.
+    If the pickle cannot be read, for example after upgrading biom-format,
+    or the cache cannot be written, the BIOM file is read anyway.
+    :param filepath: Complete filepath to BIOM file
+    :param cache: If true, parsed tables are cached as pickles.
+    :param cache_dir: Directory where pickles are stored
+    :return: BIOM table
+    """
+    if not cache:
+        return load_table(filepath)
+    stat = os.stat(filepath)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cache_file = os.path.join(cache_dir,
+                              hashlib.sha1(os.path.abspath(filepath).encode()).hexdigest() + '.pkl')
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'rb') as file:
+                cached_stamp, parts = pickle.load(file)
+            if cached_stamp == stamp:
+                return Table(*parts)
+        except Exception:
+            logger.warning("Cached copy of " + filepath + " cannot be read, reading BIOM file.")
+    biomtab = load_table(filepath)
+    tmp_file = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # the pickle is written to a temporary file first,
+        # so other processes never read a partial pickle
+        with tempfile.NamedTemporaryFile('wb', dir=cache_dir, delete=False) as file:
+            tmp_file = file.name
+            pickle.dump((stamp, _table_parts(biomtab)), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except Exception:
+        logger.warning("Could not cache BIOM file " + filepath + ".")
+        if tmp_file and os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+    return biomtab
+
+
+def _table_parts(biomtab):
+    """
+    Returns the arguments needed to construct a copy of a BIOM table.
+    The metadata of biom-format tables is stored in dictionaries with lambda defaults,
+    so it is converted to plain dictionaries.
+    :param biomtab: BIOM table
+    :return: Tuple of arguments for the Table constructor
+    """
+    metadata = [biomtab.metadata(axis=axis) for axis in ['observation', 'sample']]
+    metadata = [None if x is None else [dict(y) for y in x] for x in metadata]
+    return (biomtab.matrix_data, biomtab.ids(axis='observation'), biomtab.ids(axis='sample'),
+            metadata[0], metadata[1], biomtab.table_id, biomtab.type,
+            biomtab.create_date, biomtab.generated_by,
+            biomtab.group_metadata(axis='observation'), biomtab.group_metadata(axis='sample'))
+
+
+def _write_import_csv(records, header, filename):
+    """
+    Writes a list of tuples to a CSV file with a header for neo4j-admin import.
+    :param records: List of tuples, with one value for each column in the header
+    :param header: List of neo4j-admin import column names
+    :param filename: Complete filepath of CSV file
+    :return: Filepath of CSV file
+    """
+    table = pd.DataFrame(records, columns=header)
+    table.to_csv(filename, index=False)
+    return filename
+
+
+def _upload_biom(biomfile, name, filepath, driver, obs=True, bulk=False):
+    """
+    Uploads a BIOM object to the database,
+    or writes it to CSV files for neo4j-admin import if bulk is true.
+    :param biomfile: BIOM object
+    :param name: Name of Experiment node
+    :param filepath: Filepath where CSV files are written
+    :param driver: Biom2Neo driver instance
+    :param obs: If false, counts aren't uploaded.
+    :param bulk: If true, files are written to CSV files for neo4j-admin import.
+    :return:
+    """
+    if bulk:
+        command = driver.convert_biom_csv(biomfile=biomfile, exp_id=name, out_dir=filepath, obs=obs)
+        logger.info('Written CSV files for ' + name + '. Import these into an empty, '
+                    'stopped database with: \n' + command)
     else:
-        checked_path = _get_path(path=files, default=filepath)
-        if checked_path:
-            biomtab = load_table(checked_path)
-            name = files.split('/')[-1]
-            name = name.split('\\')[-1]
-            name = name.split(".")[0]
-            driver.convert_biom(biomfile=biomtab, exp_id=name)
-        else:
-            logger.error("Unable to read BIOM file, path is incorrect.")
-            sys.exit()
+        driver.convert_biom(biomfile=biomfile, exp_id=name, obs=obs)
 
 
 def read_tabs(inputs, i):
@@ -190,7 +399,7 @@ def read_tabs(inputs, i):
     file_prefix = ''
     checked_path = _get_path(path=input_fp, default=filepath)
     if checked_path:
-        biomtab = load_table(checked_path)
+        biomtab = _cached_load_table(checked_path, cache=inputs.get('cache', False))
         file_prefix = ''
         if os.path.isfile(os.getcwd() + '/' + input_fp):
             file_prefix = os.getcwd() + '/'
@@ -199,52 +408,62 @@ def read_tabs(inputs, i):
     else:
         logger.warning("Failed to combine input files.", exc_info=True)
         sys.exit()
-    name = input_fp.split('/')[-1]
-    name = name.split('\\')[-1]
-    name = name.split(".")[0]
+    name = os.path.splitext(os.path.basename(input_fp))[0]
     # sample metadata is not mandatory, catches None
     try:
         sample_metadata_fp = file_prefix + inputs['sample_meta'][i]
-    except TypeError or KeyError:
+    except (TypeError, KeyError):
         pass
     if sample_metadata_fp is not None:
-        sample_f = open(sample_metadata_fp, 'r')
-        sample_data = MetadataMap.from_file(sample_f)
-        sample_f.close()
+        sample_data = _read_metadata(sample_metadata_fp)
         biomtab.add_metadata(sample_data, axis='sample')
     # taxonomy is recommended, many functions don't work without it
     # still capture None
     try:
         observation_metadata_fp = file_prefix + inputs['tax_table'][i]
-    except TypeError or KeyError:
+    except (TypeError, KeyError):
         pass
     if observation_metadata_fp is not None:
-        obs_f = open(observation_metadata_fp, 'r')
-        obs_data = MetadataMap.from_file(obs_f)
-        obs_f.close()
+        obs_data = _read_metadata(observation_metadata_fp)
         # for taxonomy collapsing,
         # metadata variable needs to be a complete list
         # not separate entries for each tax level
-        for b in list(obs_data):
-            tax = list()
-            for l in list(obs_data[b]):
-                tax.append(obs_data[b][l])
-                obs_data[b].pop(l, None)
-            obs_data[b]['taxonomy'] = tax
+        obs_data = {b: {'taxonomy': list(v.values())} for b, v in obs_data.items()}
         biomtab.add_metadata(obs_data, axis='observation')
     # observation metadata is not mandatory, catches None
+    taxon_metadata_fp = None
     try:
-        observation_metadata_fp = file_prefix + inputs['taxon_meta'][i]
-    except TypeError or KeyError:
+        taxon_metadata_fp = file_prefix + inputs['taxon_meta'][i]
+    except (TypeError, KeyError):
         pass
-    if observation_metadata_fp is not None:
-        obs_f = open(observation_metadata_fp, 'r')
-        obs_data = MetadataMap.from_file(obs_f)
-        obs_f.close()
+    if taxon_metadata_fp is not None:
+        obs_data = _read_metadata(taxon_metadata_fp)
         biomtab.add_metadata(obs_data, axis='observation')
     return name, biomtab
 
 
+def _read_metadata(filepath):
+    """
+    Reads a tab-delimited metadata file with the C parser of pandas.
+    The file is read like biom's MetadataMap.from_file:
+    the header may start with #, later lines starting with # are comments,
+    and quotes and surrounding whitespace are removed from all values.
+    The first column is used as index,
+    and empty cells are kept as empty strings.
+    :param filepath: Complete filepath to metadata file
+    :return: Dictionary of dictionaries that can be added to a BIOM table
+    """
+    metadata = pd.read_csv(filepath, sep='\t', index_col=0, dtype=str, keep_default_na=False).fillna('')
+    metadata.index = metadata.index.str.replace('"', '', regex=False).str.strip()
+    if metadata.index.name:
+        metadata.index.name = metadata.index.name.lstrip('#')
+    # only the header can start with #, other rows starting with # are comments
+    metadata = metadata[~metadata.index.str.startswith('#')]
+    metadata.columns = metadata.columns.str.replace('"', '', regex=False).str.strip()
+    metadata = metadata.apply(lambda column: column.str.replace('"', '', regex=False).str.strip())
+    return metadata.to_dict(orient='index')
+
+
 def read_taxonomy(filename, filepath):
     """
     Reads tab-delimited file representing a taxonomy table.
@@ -255,13 +474,14 @@ def read_taxonomy(filename, filepath):
     taxtab = None
     checked_path = _get_path(path=filename, default=filepath)
     if checked_path:
-        taxtab = pd.read_csv(checked_path, sep='\t', index_col=0)
+        # taxonomy tables only contain strings,
+        # so type inference and NaN detection are skipped
+        taxtab = pd.read_csv(checked_path, sep='\t', index_col=0, dtype=str,
+                             engine='c', na_filter=False, memory_map=True)
     else:
         logger.warning("Failed to read taxonomy table.", exc_info=True)
         sys.exit()
-    name = filename.split('/')[-1]
-    name = name.split('\\')[-1]
-    name = name.split(".")[0]
+    name = os.path.splitext(os.path.basename(filename))[0]
     # sample metadata is not mandatory, catches None
     return name, taxtab
 
@@ -286,17 +506,8 @@ def read_qiime2(files, filepath, driver):
     :param driver: Biom2Neo driver instance
     :return:
     """
-    if os.path.isdir(files):
-        for y in os.listdir(files):
-            filepath = files + '/' + y
-            _upload_qiime2(filepath, driver)
-    else:
-        checked_path = _get_path(path=files, default=filepath)
-        if checked_path:
-            _upload_qiime2(checked_path, driver)
-        else:
-            logger.error("Unable to read qza file, path is incorrect.")
-            sys.exit()
+    for y in _list_files(files, filepath, 'qza'):
+        _upload_qiime2(y, driver)
 
 
 def _upload_qiime2(filepath, driver):
@@ -304,10 +515,13 @@ def _upload_qiime2(filepath, driver):
     if artifact['type'] == 'FeatureTable[Frequency]':
         name = artifact['uuid']
         driver.convert_biom(biomfile=file, exp_id=name)
-        driver.query("MATCH (n:Experiment {name: '" + name +
-                     "'}) SET n.type = '" + artifact['type'] +
-                     "' SET n.format = '" + artifact['format'] +
-                     "' RETURN n.format")
+        # parameterized, so the query plan is cached across artifacts
+        driver.write("WITH $batch as batch "
+                     "UNWIND batch as record "
+                     "MATCH (n:Experiment {name: record.name}) "
+                     "SET n.type = record.type, n.format = record.format "
+                     "RETURN n.format",
+                     batch=[{'name': name, 'type': artifact['type'], 'format': artifact['format']}])
     elif artifact['type'] == 'FeatureData[Taxonomy]':
         name = artifact['uuid']
         driver.convert_taxonomy(file, name)
@@ -317,46 +531,57 @@ def _load_qiime2(filepath):
     """
     Loads a Qiime2 Artifact object and
     returns this object as a tuple of metadata and BIOM table.
+    Only the metadata and data file are read from the archive;
+    the rest of the archive is never written to disk.
 
     :param filepath: Complete filepath to Qiime2 object
     :return:
     """
     filepath = Path(filepath)
-    # create temp directory
-    dirpath = tempfile.mkdtemp()
-    if zipfile.is_zipfile(str(filepath)):
-        with zipfile.ZipFile(str(filepath), mode='r') as file:
-            file.extractall(dirpath)
-    else:
-        shutil.rmtree(dirpath)
+    if not zipfile.is_zipfile(str(filepath)):
         logger.error("This file is not an archive, quitting mako.")
         sys.exit()
-    toplevel = os.listdir(dirpath)[0]
-    # read metadata
-    with open(dirpath + "/" + toplevel + "/metadata.yaml", 'r') as stream:
-        artifact = yaml.safe_load(stream)
-    try:
-        if artifact['type'] == 'FeatureTable[Frequency]':
-            file = load_table(dirpath + "/" + toplevel + "/data/feature-table.biom")
-
-        elif artifact['type'] == 'FeatureData[Taxonomy]':
-            file = pd.read_table(dirpath + "/" + toplevel + "/data/taxonomy.tsv", sep='\t')
-            file[['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']] = \
-                file['Taxon'].str.split('; ', 7, expand=True)
-            file = file.set_index('Feature ID')
-            file = file.drop(['Taxon', 'Confidence'], axis=1)
-        else:
-            logger.error("Archive type " + artifact['type']+ " not supported by mako.")
+    with zipfile.ZipFile(str(filepath), mode='r') as archive:
+        toplevel = archive.namelist()[0].split('/')[0]
+        # read metadata
+        artifact = yaml.safe_load(archive.read(toplevel + "/metadata.yaml"))
+        try:
+            if artifact['type'] == 'FeatureTable[Frequency]':
+                # load_table needs a filepath for HDF5 files,
+                # so only the feature table is extracted
+                dirpath = tempfile.mkdtemp()
+                try:
+                    file = load_table(archive.extract(toplevel + "/data/feature-table.biom", dirpath))
+                finally:
+                    shutil.rmtree(dirpath)
+            elif artifact['type'] == 'FeatureData[Taxonomy]':
+                file = pd.read_table(io.BytesIO(archive.read(toplevel + "/data/taxonomy.tsv")), sep='\t')
+                file[['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']] = \
+                    file['Taxon'].str.split('; ', 7, expand=True)
+                file = file.set_index('Feature ID')
+                file = file.drop(['Taxon', 'Confidence'], axis=1)
+            else:
+                logger.error("Archive type " + artifact['type']+ " not supported by mako.")
+                sys.exit()
+        except KeyError:
+            logger.error("Could not find a feature-table file in the archive.")
             sys.exit()
-    except FileNotFoundError:
-        shutil.rmtree(dirpath)
-        logger.error("Could not find a feature-table file in the archive.")
-        sys.exit()
-    # delete temp directory
-    shutil.rmtree(dirpath)
     return artifact, file
 
 
+def _valid_label(label):
+    """
+    Checks whether a taxonomic label is a complete assignment,
+    and not empty or just a prefix (e.g. 'g__').
+    :param label: Taxonomic label
+    :return: True if the label should be written to the database
+    """
+    if label and not pd.isna(label):
+        if len(label) > 4:
+            return True
+    return False
+
+
 class Biom2Neo(ParentDriver):
     """
     Initializes a Neo4j driver for interacting with the Neo4j database.
@@ -380,74 +605,136 @@ class Biom2Neo(ParentDriver):
         :return:
         """
         try:
-            # first check if sample metadata exists
             with self._driver.session() as session:
+                # first check if sample metadata exists
                 session.write_transaction(self._create_experiment, exp_id)
-            taxon_query_dict = self._create_taxon_dict(biomfile)
-            with self._driver.session() as session:
+                # indices are created before the MERGE queries that rely on them
+                session.write_transaction(self._create_indices)
+                taxon_query_dict = self._create_taxon_dict(biomfile)
+                # all observation metadata is read in a single pass;
+                # taxonomy dictionaries are then written in a single transaction
+                create_dict, connect_dict, add_dict, metadata_query_dict1, metadata_query_dict2 = \
+                    self._create_obs_meta_dicts(biomfile)
+                sampledata_query_dict1, sampleproperty_query_dict2, sampleproperty_query_dict3 = \
+                    self._create_sample_dict(biomfile, exp_id)
+                # taxon and sample properties are created in the same transaction
+                property_labels = {x['label'] for x in metadata_query_dict1 + sampleproperty_query_dict2}
+                if len(property_labels) > 0:
+                    session.write_transaction(self._create_property, [{'label': x} for x in property_labels])
+
                 # Add taxon nodes
                 session.write_transaction(self._create_taxon, taxon_query_dict)
-            tax_levels = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
-            try:
-                taxonomy_table = biomfile.metadata_to_dataframe(axis='observation').drop_duplicates()
-                # default naming scheme filters columns
-                matching_indices = set(taxonomy_table.columns).intersection(['taxonomy_0', 'taxonomy_1', 'taxonomy_2',
-                                                 'taxonomy_3', 'taxonomy_4', 'taxonomy_5',
-                                                 'taxonomy_6'])
-                taxonomy_table = taxonomy_table[matching_indices]
-                taxonomy_table = taxonomy_table.reindex(sorted(taxonomy_table.columns), axis=1)
-                for i in reversed(range(len(matching_indices))):
-                    level = tax_levels[i]
-                    taxonomy_query_dict = self._create_taxonomy_dict(taxonomy_table, i)
-                    with self._driver.session() as session:
-                        session.write_transaction(self._create_taxonomy, level, taxonomy_query_dict)
-                for i in reversed(range(1, len(matching_indices))):
-                    # Connect each taxonomic label to its higher-level label
-                    lower_level = tax_levels[i]
-                    upper_level = tax_levels[i-1]
-                    taxonomy_query_dict = self._connect_taxonomy_dict(taxonomy_table, i)
-                    with self._driver.session() as session:
-                        session.write_transaction(self._connect_taxonomy, lower_level, upper_level,
-                                                  taxonomy_query_dict)
-                for i in range(len(matching_indices)):
-                    taxonomy_query_dict = self._add_taxonomy_dict(biomfile, i)
-                    if len(taxonomy_query_dict) > 0:
-                        with self._driver.session() as session:
-                            session.write_transaction(self._add_taxonomy, tax_levels[i], taxonomy_query_dict)
-            except KeyError:
-                pass
-            try:
-                tax_meta = biomfile.metadata_to_dataframe(axis='observation')
-                metadata_query_dict1, metadata_query_dict2 = self._create_meta_dict(tax_meta, biomfile)
-                if len(metadata_query_dict1) > 0:
-                    with self._driver.session() as session:
-                        session.write_transaction(self._create_property, metadata_query_dict1)
+                if len(create_dict) > 0:
+                    session.write_transaction(self._write_taxonomy, create_dict, connect_dict, add_dict)
                 if len(metadata_query_dict2) > 0:
-                    with self._driver.session() as session:
-                        session.write_transaction(self._connect_property, metadata_query_dict2, sourcetype='Taxon')
-            except KeyError:
-                pass
-            sampledata_query_dict1, sampleproperty_query_dict2, sampleproperty_query_dict3 = self._create_sample_dict(biomfile, exp_id)
-            if len(sampledata_query_dict1) > 0:
-                with self._driver.session() as session:
+                    session.write_transaction(self._connect_property, metadata_query_dict2,
+                                              sourcetype='Taxon')
+                # taxa and samples are written one after the other,
+                # since both link to the same Property nodes and would lock each other
+                if len(sampledata_query_dict1) > 0:
                     session.write_transaction(self._create_sample, sampledata_query_dict1)
-            if len(sampleproperty_query_dict2) > 0:
-                with self._driver.session() as session:
-                    session.write_transaction(self._create_property, sampleproperty_query_dict2)
-            with self._driver.session() as session:
-                session.write_transaction(self._create_indices)
-            if len(sampleproperty_query_dict3) > 0:
-                with self._driver.session() as session:
-                    session.write_transaction(self._connect_property, sampleproperty_query_dict3, sourcetype='Specimen')
-            if obs:
-                observations = self._create_obs_dict(biomfile)
-            else:
-                observations = self._create_obs_dict_alt(tax_meta, exp_id)
-            with self._driver.session() as session:
-                session.write_transaction(self._create_observations, observations)
+                if len(sampleproperty_query_dict3) > 0:
+                    session.write_transaction(self._connect_property, sampleproperty_query_dict3,
+                                              sourcetype='Specimen')
+                if obs:
+                    # each batch of observations is committed by the server in chunks
+                    for observations in self._iter_obs_batches(biomfile):
+                        self._retry_transient(self._create_observations, session, observations,
+                                              cleanup=self._delete_observations)
+                else:
+                    observations = self._create_obs_dict_alt(biomfile.ids(axis='observation'), exp_id)
+                    self._retry_transient(self._create_observations, session, observations,
+                                          cleanup=self._delete_observations)
         except Exception:
             logger.error("Could not write BIOM file to database. \n", exc_info=True)
 
+    def convert_biom_csv(self, biomfile, exp_id, out_dir, obs=True):
+        """
+        Writes a BIOM object to CSV files in the format used by neo4j-admin import.
+        For initial loads of large BIOM files, the offline importer
+        is much faster than transactional batch queries.
+        The same dictionaries as for convert_biom are used,
+        so the resulting graph follows the same data model.
+        Node names are used as IDs, with a separate ID space for each label.
+        Taxon nodes shared across BIOM files are duplicates,
+        so the import needs to skip duplicate nodes.
+
+        :param biomfile: BIOM file.
+        :param exp_id: Label of experiment used to generate BIOM file.
+        :param out_dir: Directory where the CSV files are written.
+        :param obs: Relationships between samples and taxa are only written if obs is set to True.
+        :return: neo4j-admin command for importing the CSV files
+        """
+        prefix = out_dir + '/' + exp_id + '_'
+        nodes = list()
+        relationships = list()
+        taxon_query_dict = self._create_taxon_dict(biomfile)
+        create_dict, connect_dict, add_dict, metadata_query_dict1, metadata_query_dict2 = \
+            self._create_obs_meta_dicts(biomfile)
+        sampledata_query_dict1, sampleproperty_query_dict2, sampleproperty_query_dict3 = \
+            self._create_sample_dict(biomfile, exp_id)
+        nodes.append(_write_import_csv([(exp_id, 'Experiment')],
+                                       ['name:ID(Experiment)', ':LABEL'],
+                                       prefix + 'experiment.csv'))
+        nodes.append(_write_import_csv([(x['taxon'], 'Taxon') for x in taxon_query_dict],
+                                       ['name:ID(Taxon)', ':LABEL'],
+                                       prefix + 'taxa.csv'))
+        nodes.append(_write_import_csv([(x['sample'], 'Specimen') for x in sampledata_query_dict1],
+                                       ['name:ID(Specimen)', ':LABEL'],
+                                       prefix + 'specimens.csv'))
+        records = [(x['sample'], x['exp_id'], 'PART_OF') for x in sampledata_query_dict1]
+        relationships.append(_write_import_csv(records,
+                                               [':START_ID(Specimen)', ':END_ID(Experiment)', ':TYPE'],
+                                               prefix + 'part_of.csv'))
+        for level in create_dict:
+            nodes.append(_write_import_csv([(x['label'], level) for x in create_dict[level]],
+                                           ['name:ID(' + level + ')', ':LABEL'],
+                                           prefix + level + '.csv'))
+        for lower_level, upper_level in connect_dict:
+            # upper-level labels without an assignment are not written as nodes,
+            # so these connections are skipped
+            records = [(x['label1'], x['label2'], 'MEMBER_OF') for x in connect_dict[(lower_level, upper_level)]
+                       if _valid_label(x['label2'])]
+            relationships.append(_write_import_csv(records,
+                                                   [':START_ID(' + lower_level + ')',
+                                                    ':END_ID(' + upper_level + ')', ':TYPE'],
+                                                   prefix + lower_level + '_member_of.csv'))
+        for level in add_dict:
+            records = [(x['taxon'], x['level'], 'MEMBER_OF') for x in add_dict[level]]
+            relationships.append(_write_import_csv(records,
+                                                   [':START_ID(Taxon)', ':END_ID(' + level + ')', ':TYPE'],
+                                                   prefix + 'taxon_member_of_' + level + '.csv'))
+        properties = {x['label'] for x in metadata_query_dict1 + sampleproperty_query_dict2}
+        if len(properties) > 0:
+            nodes.append(_write_import_csv([(x, 'Property') for x in properties],
+                                           ['name:ID(Property)', ':LABEL'],
+                                           prefix + 'properties.csv'))
+        if len(metadata_query_dict2) > 0:
+            records = [(x['source'], x['name'], x['value'], 'QUALITY_OF') for x in metadata_query_dict2]
+            relationships.append(_write_import_csv(records,
+                                                   [':START_ID(Taxon)', ':END_ID(Property)', 'value', ':TYPE'],
+                                                   prefix + 'taxon_quality_of.csv'))
+        if len(sampleproperty_query_dict3) > 0:
+            records = [(x['source'], x['name'], x['value'], 'QUALITY_OF') for x in sampleproperty_query_dict3]
+            relationships.append(_write_import_csv(records,
+                                                   [':START_ID(Specimen)', ':END_ID(Property)', 'value', ':TYPE'],
+                                                   prefix + 'specimen_quality_of.csv'))
+        if obs:
+            # observations are written directly from the sparse matrix,
+            # without constructing a dictionary for each count
+            coo = biomfile.matrix_data.tocoo()
+            nonzero = coo.data != 0
+            observations = pd.DataFrame({':START_ID(Taxon)': biomfile.ids(axis='observation')[coo.row[nonzero]],
+                                         ':END_ID(Specimen)': biomfile.ids(axis='sample')[coo.col[nonzero]],
+                                         'count:float': coo.data[nonzero],
+                                         ':TYPE': 'LOCATED_IN'})
+            observations.to_csv(prefix + 'located_in.csv', index=False, chunksize=100000)
+            relationships.append(prefix + 'located_in.csv')
+        command = "neo4j-admin import --skip-duplicate-nodes=true " + \
+                  " ".join(['--nodes=' + x for x in nodes]) + " " + \
+                  " ".join(['--relationships=' + x for x in relationships])
+        return command
+
     def convert_taxonomy(self, taxonomy_table, exp_id):
         """
         Stores a taxonomy dataframe in the database.
@@ -460,43 +747,74 @@ class Biom2Neo(ParentDriver):
         :return:
         """
         try:
-            # first check if sample metadata exists
             with self._driver.session() as session:
+                # first check if sample metadata exists
                 session.write_transaction(self._create_experiment, exp_id)
-            taxon_query_dict = self._create_taxon_dict_alt(taxonomy_table)
-            with self._driver.session() as session:
+                session.write_transaction(self._create_indices)
+                taxon_query_dict = self._create_taxon_dict_alt(taxonomy_table)
                 # Add taxon nodes
                 session.write_transaction(self._create_taxon, taxon_query_dict)
-            tax_levels = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
-            try:
-                for i in reversed(range(len(taxonomy_table.columns))):
-                    level = tax_levels[i]
-                    taxonomy_query_dict = self._create_taxonomy_dict(taxonomy_table, i)
-                    with self._driver.session() as session:
-                        session.write_transaction(self._create_taxonomy, level, taxonomy_query_dict)
-                for i in reversed(range(1, len(taxonomy_table.columns))):
-                    # Connect each taxonomic label to its higher-level label
-                    lower_level = tax_levels[i]
-                    upper_level = tax_levels[i-1]
-                    taxonomy_query_dict = self._connect_taxonomy_dict(taxonomy_table, i)
-                    with self._driver.session() as session:
-                        session.write_transaction(self._connect_taxonomy, lower_level, upper_level,
-                                                  taxonomy_query_dict)
-                for i in range(len(taxonomy_table.columns)):
-                    taxonomy_query_dict = self._add_taxonomy_dict_alt(taxonomy_table, i)
-                    if len(taxonomy_query_dict) > 0:
-                        with self._driver.session() as session:
-                            session.write_transaction(self._add_taxonomy, tax_levels[i], taxonomy_query_dict)
-                with self._driver.session() as session:
+                try:
+                    create_dict = dict()
+                    connect_dict = dict()
+                    add_dict = dict()
+                    # many taxa share a lineage, so duplicate rows are dropped once
+                    # instead of in every per-level pass
+                    unique_table = taxonomy_table.drop_duplicates()
+                    for i in reversed(range(len(unique_table.columns))):
+                        create_dict[_tax_levels[i]] = self._create_taxonomy_dict(unique_table, i)
+                    for i in reversed(range(1, len(unique_table.columns))):
+                        # Connect each taxonomic label to its higher-level label
+                        connect_dict[(_tax_levels[i], _tax_levels[i-1])] = \
+                            self._connect_taxonomy_dict(unique_table, i)
+                    for i in range(len(taxonomy_table.columns)):
+                        add_dict[_tax_levels[i]] = self._add_taxonomy_dict_alt(taxonomy_table, i)
+                    session.write_transaction(self._write_taxonomy, create_dict, connect_dict, add_dict)
                     session.write_transaction(self._create_ref_sample, exp_id)
-                observations = self._create_obs_dict_alt(taxonomy_table, exp_id)
-                with self._driver.session() as session:
-                    session.write_transaction(self._create_observations, observations)
-            except KeyError:
-                pass
+                    observations = self._create_obs_dict_alt(taxonomy_table.index, exp_id)
+                    self._retry_transient(self._create_observations, session, observations,
+                                          cleanup=self._delete_observations)
+                except KeyError:
+                    pass
         except Exception:
             logger.error("Could not write taxonomy file to database. \n", exc_info=True)
 
+    def create_constraints(self):
+        """
+        Creates unique constraints on the names of nodes that are shared across files,
+        so uploads that run in parallel cannot create duplicates of these nodes.
+        Neo4j does not allow a constraint next to an index on the same property,
+        so the plain index on name is dropped for one label at a time.
+        If the constraint for that label cannot be created,
+        for example because the database already contains duplicate names,
+        the index is created again before the next label is handled.
+        :return: True if all shared labels have a unique constraint on name
+        """
+        labels = ['Experiment', 'Property', 'Specimen', 'Taxon'] + _tax_levels
+        try:
+            with self._driver.session() as session:
+                missing = session.read_transaction(self._missing_constraints, labels)
+                if len(missing) > 0:
+                    logger.info("Replacing indices on node names with unique constraints "
+                                "for parallel uploads. Labels: " + ", ".join(missing) + ".")
+                for label in missing:
+                    indices = session.read_transaction(self._name_indices, [label])
+                    for index in indices:
+                        session.write_transaction(self._query, "DROP INDEX `" + index + "` IF EXISTS")
+                    try:
+                        session.write_transaction(self._query, "CREATE CONSTRAINT IF NOT EXISTS "
+                                                               "FOR (n:" + label + ") REQUIRE n.name IS UNIQUE")
+                    except Exception:
+                        logger.warning("Could not create a unique constraint on " + label + " names. \n",
+                                       exc_info=True)
+                        if len(indices) > 0:
+                            session.write_transaction(_create_name_indices, [label])
+                missing = session.read_transaction(self._missing_constraints, labels)
+        except Exception:
+            logger.warning("Could not create unique constraints. \n", exc_info=True)
+            return False
+        return len(missing) == 0
+
     def delete_biom(self, exp_id):
         """
         Takes the experiment ID to remove all samples linked to the experiment.
@@ -504,22 +822,14 @@ class Biom2Neo(ParentDriver):
         :return:
         """
         with self._driver.session() as session:
-            samples = session.read_transaction(self._samples_to_delete, exp_id)
-        deletion_dict = list()
-        for sample in samples:
-            deletion_dict.append({'sample': sample['a.name'], 'exp_id': exp_id})
-        with self._driver.session() as session:
-            session.write_transaction(self._delete_sample, deletion_dict)
-        logger.info('Detached samples...')
-        with self._driver.session() as session:
-            taxa = session.read_transaction(self._taxa_to_delete)
-        deletion_dict = list()
-        for tax in taxa:
-            deletion_dict.append({'taxon': tax['a.name']})
-        with self._driver.session() as session:
-                session.write_transaction(self._delete_taxon, deletion_dict)
-        logger.info('Removed disconnected taxa...')
-        self.write(("MATCH (a:Experiment {name: '" + exp_id + "'}) DETACH DELETE a"))
+            # batched deletion with CALL {} IN TRANSACTIONS
+            # is only allowed in auto-commit transactions,
+            # so these queries run on the session directly
+            self._retry_transient(self._delete_sample, session, exp_id)
+            logger.info('Detached samples...')
+            self._retry_transient(self._delete_taxon, session)
+            logger.info('Removed disconnected taxa...')
+            session.write_transaction(self._delete_experiment, exp_id)
         logger.info('Finished deleting ' + exp_id + '.')
 
     @staticmethod
@@ -557,14 +867,9 @@ class Biom2Neo(ParentDriver):
         :param i: index of taxonomic level
         :return:
         """
-        taxonomy_table_i = set(taxonomy_table.iloc[:, i])
-        # Create each taxonomic label
-        taxonomy_query_dict = list()
-        for val in taxonomy_table_i:
-            # filters out empty assignments with just prefix or None
-            if val and not pd.isna(val):
-                if len(val) > 4:
-                    taxonomy_query_dict.append({'label': val})
+        # filters out empty assignments with just prefix or None
+        taxonomy_query_dict = [{'label': val} for val in taxonomy_table.iloc[:, i].dropna().unique()
+                               if _valid_label(val)]
         return taxonomy_query_dict
 
     @staticmethod
@@ -576,71 +881,90 @@ class Biom2Neo(ParentDriver):
         :param i: index of taxonomic level
         :return:
         """
-        taxonomy_query_dict = list()
-        taxonomy_table_i = taxonomy_table.iloc[:, [i, i - 1]].drop_duplicates()
-        for index, row in taxonomy_table_i.iterrows():
-            # filters out empty assignments with just prefix
-            if row[0] and not pd.isna(row[0]):
-                if len(row[0]) > 4:
-                    taxonomy_query_dict.append({'label1': row[0], 'label2': row[1]})
+        taxonomy_table_i = taxonomy_table.iloc[:, [i, i - 1]].dropna().drop_duplicates()
+        # filters out empty assignments with just prefix
+        taxonomy_table_i = taxonomy_table_i[taxonomy_table_i.iloc[:, 0].str.len() > 4]
+        taxonomy_table_i.columns = ['label1', 'label2']
+        taxonomy_query_dict = taxonomy_table_i.to_dict('records')
         return taxonomy_query_dict
 
     @staticmethod
-    def _add_taxonomy_dict(biomfile, i):
+    def _add_taxonomy_dict_alt(taxonomy_table, i):
         """
         Creates a taxonomy dictionary to connect taxa to taxonomy nodes.
-        :param biomfile: BIOM object
+        :param taxonomy_table: Pandas dataframe
         :param i: Index of taxonomy level
         :return:
         """
-        taxonomy_query_dict = list()
-        for taxon in biomfile.ids(axis='observation'):
-            tax_index = biomfile.index(axis='observation', id=taxon)
-            tax_labels = biomfile.metadata(axis='observation')[tax_index]['taxonomy']
-            if tax_labels[i] and not pd.isna(tax_labels[i]):
-                if len(tax_labels[i]) > 4:
-                    taxonomy_query_dict.append({'taxon': taxon, 'level': tax_labels[i]})
+        taxonomy_table_i = taxonomy_table.iloc[:, i]
+        # filters out empty assignments with just prefix or None
+        mask = taxonomy_table_i.notna() & taxonomy_table_i.astype(str).str.len().gt(4)
+        taxonomy_query_dict = [{'taxon': tax_name, 'level': tax_label}
+                               for tax_name, tax_label in zip(taxonomy_table.index[mask], taxonomy_table_i[mask])]
+        taxonomy_query_dict.sort(key=lambda x: x['level'])
         return taxonomy_query_dict
 
     @staticmethod
-    def _add_taxonomy_dict_alt(taxonomy_table, i):
+    def _walk_obs_meta(biomfile):
         """
-        Creates a taxonomy dictionary to connect taxa to taxonomy nodes.
-        :param taxonomy_table: Pandas dataframe
-        :param i: Index of taxonomy level
-        :return:
+        Iterates once over the observation metadata of a BIOM object.
+        The taxonomy is split off from the other metadata properties.
+        :param biomfile: BIOM object
+        :return: Generator of tuples with taxon ID, taxonomy tuple and dictionary of other metadata
         """
-        taxonomy_query_dict = list()
-        for j in range(len(taxonomy_table.index)):
-            tax_name = list(taxonomy_table.index)[j]
-            tax_label = taxonomy_table.iloc[j][i]
-            if tax_label and not pd.isna(tax_label):
-                if len(tax_label) > 4:
-                    taxonomy_query_dict.append({'taxon': tax_name, 'level': tax_label})
-        return taxonomy_query_dict
+        metadata = biomfile.metadata(axis='observation')
+        if metadata is None:
+            return
+        for taxon, meta in zip(biomfile.ids(axis='observation'), metadata):
+            if meta is None:
+                meta = dict()
+            taxonomy = tuple()
+            if 'taxonomy' in meta and not isinstance(meta['taxonomy'], str):
+                taxonomy = tuple(meta['taxonomy'][:7])
+            properties = {key: meta[key] for key in meta if key != 'taxonomy'}
+            yield taxon, taxonomy, properties
 
     @staticmethod
-    def _create_meta_dict(tax_meta, biomfile):
+    def _create_obs_meta_dicts(biomfile):
         """
-        Takes taxon metadata (not taxonomy) and makes a dictionary for those metadata properties.
-        :param tax_meta: Dataframe of taxon metadata.
-        :param biomfile: BIOM object.
+        Creates all dictionaries derived from observation metadata in a single pass:
+        taxonomy nodes, connections between taxonomy nodes,
+        connections between taxa and taxonomy nodes,
+        and taxon metadata (not taxonomy) properties.
+        :param biomfile: BIOM object
         :return:
         """
-        metadata_query_dict1 = list()
-        for column in tax_meta.columns:
-            if 'taxonomy' not in column:
-                metadata_query_dict1.append({'label': column})
+        taxonomies = set()
+        add_dict = {level: list() for level in _tax_levels}
+        property_labels = list()
         metadata_query_dict2 = list()
-        for taxon in biomfile.ids(axis='observation'):
-            tax_index = biomfile.index(axis='observation', id=taxon)
-            if len(tax_meta) > 0:
-                meta = biomfile.metadata(axis='observation')[tax_index]
-                for key in meta:
-                    if key != 'taxonomy' and type(meta[key]) == str:
-                        metadata_query_dict2.append({'source': taxon,
-                                                    'value': meta[key], 'name': key})
-        return metadata_query_dict1, metadata_query_dict2
+        for taxon, taxonomy, properties in Biom2Neo._walk_obs_meta(biomfile):
+            taxonomies.add(taxonomy)
+            for i in range(len(taxonomy)):
+                # filters out empty assignments with just prefix or None
+                if _valid_label(taxonomy[i]):
+                    add_dict[_tax_levels[i]].append({'taxon': taxon, 'level': taxonomy[i]})
+            for key in properties:
+                if key not in property_labels:
+                    property_labels.append(key)
+                if type(properties[key]) == str:
+                    metadata_query_dict2.append({'source': taxon,
+                                                 'value': properties[key], 'name': key})
+        depth = max([len(x) for x in taxonomies], default=0)
+        create_dict = dict()
+        connect_dict = dict()
+        for i in reversed(range(depth)):
+            labels = {x[i] for x in taxonomies if len(x) > i}
+            create_dict[_tax_levels[i]] = [{'label': x} for x in labels if _valid_label(x)]
+        for i in reversed(range(1, depth)):
+            # Connect each taxonomic label to its higher-level label
+            pairs = {(x[i], x[i-1]) for x in taxonomies if len(x) > i}
+            connect_dict[(_tax_levels[i], _tax_levels[i-1])] = [{'label1': x[0], 'label2': x[1]}
+                                                              for x in pairs if _valid_label(x[0])]
+        # sorting by taxonomic label groups rows that match the same taxonomy node
+        add_dict = {level: sorted(add_dict[level], key=lambda x: x['level']) for level in _tax_levels[:depth]}
+        metadata_query_dict1 = [{'label': x} for x in property_labels]
+        return create_dict, connect_dict, add_dict, metadata_query_dict1, metadata_query_dict2
 
     @staticmethod
     def _create_sample_dict(biomfile, exp_id):
@@ -653,53 +977,63 @@ class Biom2Neo(ParentDriver):
         sampledata_query_dict = list()
         sampleproperty_query_dict = list()
         sampleproperty_query_dict2 = list()
-        for sample in biomfile.ids(axis='sample'):
+        # sample IDs and metadata are only retrieved once,
+        # instead of looking up the metadata for every sample
+        sample_ids = biomfile.ids(axis='sample')
+        for sample in sample_ids:
             sampledata_query_dict.append({'sample': sample, 'exp_id': exp_id})
-        try:
-            sample_meta = biomfile.metadata_to_dataframe(axis='sample')
-            for column in sample_meta.columns:
-                sampleproperty_query_dict.append({'label': column})
-            for sample in biomfile.ids(axis='sample'):
-                sample_index = biomfile.index(axis='sample', id=sample)
-                if len(sample_meta) > 0:
-                    meta = biomfile.metadata(axis='sample')[sample_index]
-                    # need to clean up these 'if' conditions to catch None properties
-                    # there is also a problem with commas + quotation marks here
-                    for key in meta:
-                        sampleproperty_query_dict2.append({'source': sample,
-                                                           'value': meta[key], 'name': key})
-        except KeyError:
-            pass
+        # the metadata is walked directly,
+        # no dataframe is constructed just to get the column names
+        sample_meta = biomfile.metadata(axis='sample')
+        if sample_meta is not None:
+            labels = dict()
+            for sample, meta in zip(sample_ids, sample_meta):
+                # need to clean up these 'if' conditions to catch None properties
+                # there is also a problem with commas + quotation marks here
+                for key in meta:
+                    labels[key] = None
+                    sampleproperty_query_dict2.append({'source': sample,
+                                                       'value': meta[key], 'name': key})
+            sampleproperty_query_dict = [{'label': x} for x in labels]
         return sampledata_query_dict, sampleproperty_query_dict, sampleproperty_query_dict2
 
     @staticmethod
-    def _create_obs_dict(biomfile):
+    def _iter_obs_batches(biomfile, batch_size=10000):
         """
-        Creates a dictionary that can be used to connect taxa to samples via observation values.
+        Generates lists of dictionaries that can be used to connect taxa to samples via observation values.
+        The sparse matrix is read column by column,
+        so only a single batch of observations is held in memory.
         :param biomfile: BIOM object.
+        :param batch_size: Maximum number of observations per batch,
+        equal to the number of rows in each transaction of _create_observations.
         :return:
         """
-        obs_data = biomfile.matrix_data
-        data = [pd.Series(obs_data[i].toarray().ravel()) for i in np.arange(obs_data.shape[0])]
-        obs_data = pd.DataFrame(data, index=biomfile.ids(axis='observation'))
-        obs_data.columns = biomfile.ids(axis='sample')
-        rows, cols = np.where(obs_data.values != 0)
-        observations = list()
-        for taxon, sample in list(zip(obs_data.index[rows], obs_data.columns[cols])):
-            value = obs_data[sample][taxon]
-            observations.append({'taxon': taxon, 'sample': sample, 'value': value})
-        return observations
+        csc = biomfile.matrix_data.tocsc()
+        taxa = biomfile.ids(axis='observation')
+        samples = biomfile.ids(axis='sample')
+        batch = list()
+        for col in range(csc.shape[1]):
+            start, end = csc.indptr[col], csc.indptr[col + 1]
+            sample = samples[col]
+            for row, value in zip(csc.indices[start:end].tolist(), csc.data[start:end].tolist()):
+                if value != 0:
+                    batch.append({'taxon': taxa[row], 'sample': sample, 'value': value})
+                    if len(batch) == batch_size:
+                        yield batch
+                        batch = list()
+        if len(batch) > 0:
+            yield batch
 
     @staticmethod
-    def _create_obs_dict_alt(taxonomy_table, exp_id):
+    def _create_obs_dict_alt(taxa, exp_id):
         """
         Creates a dictionary that can be used to connect taxa to samples via observation values.
-        :param taxonomy_table: Taxonomy table.
+        :param taxa: List of taxon IDs.
         :param exp_id: Name of experiment node
         :return:
         """
         observations = list()
-        for taxon in taxonomy_table.index:
+        for taxon in taxa:
             observations.append({'taxon': taxon, 'sample': exp_id, 'value': 0})
         return observations
 
@@ -711,7 +1045,7 @@ class Biom2Neo(ParentDriver):
         :param exp_id: Label for experiment
         :return:
         """
-        tx.run("MERGE (a:Experiment {name: '" + exp_id + "'}) RETURN a")
+        tx.run("MERGE (a:Experiment {name: $exp_id}) RETURN a", exp_id=exp_id)
 
     @staticmethod
     def _create_ref_sample(tx, exp_id):
@@ -721,10 +1055,9 @@ class Biom2Neo(ParentDriver):
         :param exp_id: Name of Experiment node
         :return:
         """
-        tx.run("MERGE (a:Specimen {name: '" + exp_id + "'}) RETURN a")
-        tx.run(("MATCH (a:Specimen {name:'" + exp_id +
-                "'}), (b:Experiment {name:'" + exp_id +
-                "'}) MERGE (a)-[r:PART_OF]->(b) RETURN type(r)"))
+        tx.run("MERGE (a:Specimen {name: $exp_id}) "
+               "WITH a MATCH (b:Experiment {name: $exp_id}) "
+               "MERGE (a)-[r:PART_OF]->(b) RETURN type(r)", exp_id=exp_id)
 
     @staticmethod
     def _create_taxon(tx, taxon_query_dict):
@@ -737,55 +1070,67 @@ class Biom2Neo(ParentDriver):
         query = "WITH $batch as batch \
         UNWIND batch as record \
         MERGE (a:Taxon {name:record.taxon}) RETURN a"
+        # sorted batches step through the name index in order
+        taxon_query_dict = sorted(taxon_query_dict, key=lambda x: x['taxon'])
         _run_subbatch(tx, query, taxon_query_dict)
 
     @staticmethod
-    def _create_taxonomy(tx, level, taxonomy_query_dict):
+    def _write_taxonomy(tx, create_dict, connect_dict, add_dict):
         """
-        Creates a node that represents a taxonomic label.
+        Writes all taxonomic levels in a single transaction,
+        so the taxonomy does not need a separate commit per level.
         :param tx: Neo4j transaction
-        :param level: Label used for taxonomy node
-        :param taxonomy_query_dict: Dictionary of taxon labels
+        :param create_dict: Dictionary with levels as keys and taxonomy dictionaries as values
+        :param connect_dict: Dictionary with (lower level, upper level) tuples as keys
+        and taxonomy dictionaries as values
+        :param add_dict: Dictionary with levels as keys and taxon dictionaries as values
         :return:
         """
-        query = "WITH $batch as batch " \
-                "UNWIND batch as record " \
-                "MERGE (a:" + level + " {name:record.label}) RETURN a"
-        _run_subbatch(tx, query, taxonomy_query_dict)
+        create_batch = [{'level': level, 'label': x['label']}
+                        for level in create_dict for x in create_dict[level]]
+        Biom2Neo._create_taxonomy(tx, create_batch)
+        # upper-level labels without an assignment are not created as nodes,
+        # so these connections are skipped
+        connect_batch = [{'level': lower_level, 'label1': x['label1'], 'label2': x['label2']}
+                         for lower_level, upper_level in connect_dict
+                         for x in connect_dict[(lower_level, upper_level)] if _valid_label(x['label2'])]
+        Biom2Neo._connect_taxonomy(tx, connect_batch)
+        add_batch = [{'level': level, 'taxon': x['taxon'], 'label': x['level']}
+                     for level in add_dict for x in add_dict[level]]
+        Biom2Neo._add_taxonomy(tx, add_batch)
 
     @staticmethod
-    def _connect_taxonomy(tx, level1, level2, taxonomy_query_dict):
+    def _create_taxonomy(tx, taxonomy_query_dict):
         """
-        Connects a taxonomic label to its higher-level label.
+        Creates nodes that represent taxonomic labels.
+        The taxonomic level of each label is used as node label.
         :param tx: Neo4j transaction
-        :param level1: Label used for lower-level taxonomy node
-        :param level2: Label used for upper-level taxonomy node
-        :param taxonomy_query_dict: Dictionary of taxon label
+        :param taxonomy_query_dict: List of dictionaries with taxonomic levels and labels
         :return:
         """
-        query = "WITH $batch as batch " \
-                "UNWIND batch as record " \
-                "MATCH (a:" + level1 + " {name:record.label1}), (b:" + level2 + \
-                " {name:record.label2}) " \
-                "MERGE (a)-[r:MEMBER_OF]->(b) RETURN type(r)"
-        _run_subbatch(tx, query, taxonomy_query_dict)
+        _run_subbatch(tx, _create_taxonomy_query, taxonomy_query_dict)
 
     @staticmethod
-    def _add_taxonomy(tx, level, taxonomy_query_dict):
+    def _connect_taxonomy(tx, taxonomy_query_dict):
         """
-        Connects taxon node to taxonomy node.
+        Connects taxonomic labels to their higher-level labels.
         :param tx: Neo4j transaction
-        :param level: Label used for taxonomy node
-        :param taxonomy_query_dict: List of taxon IDs
+        :param taxonomy_query_dict: List of dictionaries with the taxonomic level
+        of the lower-level label, the lower-level label and the upper-level label
         :return:
         """
-        query = "WITH $batch as batch " \
-                "UNWIND batch as record " \
-                "MATCH (a:Taxon) " \
-                "MATCH (b:" + level + ") " \
-                "WHERE a.name = record.taxon AND b.name = record.level " \
-                "MERGE (a)-[r:MEMBER_OF]->(b) RETURN type(r)"
-        _run_subbatch(tx, query, taxonomy_query_dict)
+        _run_subbatch(tx, _connect_taxonomy_query, taxonomy_query_dict)
+
+    @staticmethod
+    def _add_taxonomy(tx, taxonomy_query_dict):
+        """
+        Connects taxon nodes to taxonomy nodes.
+        :param tx: Neo4j transaction
+        :param taxonomy_query_dict: List of dictionaries with taxon IDs,
+        taxonomic levels and labels
+        :return:
+        """
+        _run_subbatch(tx, _add_taxonomy_query, taxonomy_query_dict)
 
     @staticmethod
     def _create_sample(tx, sample_query_dict):
@@ -796,14 +1141,14 @@ class Biom2Neo(ParentDriver):
         :param exp_id: Experiment name
         :return:
         """
+        # the sample node is linked to the experiment as soon as it is merged
         query = "WITH $batch as batch " \
                 "UNWIND batch as record " \
-                "MERGE (a:Specimen {name:record.sample}) RETURN a"
-        _run_subbatch(tx, query, sample_query_dict)
-        query = "WITH $batch as batch " \
-                "UNWIND batch as record " \
-                "MATCH (a:Specimen {name:record.sample}), (b:Experiment {name:record.exp_id}) " \
+                "MERGE (a:Specimen {name:record.sample}) " \
+                "WITH a, record MATCH (b:Experiment {name:record.exp_id}) " \
                 "MERGE (a)-[r:PART_OF]->(b) RETURN type(r)"
+        # sorted batches step through the name index in order
+        sample_query_dict = sorted(sample_query_dict, key=lambda x: x['sample'])
         _run_subbatch(tx, query, sample_query_dict)
 
     @staticmethod
@@ -818,6 +1163,8 @@ class Biom2Neo(ParentDriver):
         query = "WITH $batch as batch " \
                 "UNWIND batch as record " \
                 "MERGE (a:Property {name:record.label}) RETURN a"
+        # sorted batches step through the name index in order
+        property_query_dict = sorted(property_query_dict, key=lambda x: x['label'])
         _run_subbatch(tx, query, property_query_dict)
 
     @staticmethod
@@ -829,124 +1176,155 @@ class Biom2Neo(ParentDriver):
         :param property_query_dict: List of dictionaries with property names, targets, values of relationship.
         :return:
         """
-        if len(sourcetype) > 0:
-            sourcetype = ':' + sourcetype
-        rel = ""
-        weight_rel = None
-        val_rel = None
-        if 'weight' in property_query_dict[0]:
-            weight_rel = "weight: record.weight"
-        if 'value' in property_query_dict[0]:
-            val_rel = "value: record.value"
-        if weight_rel and val_rel:
-            rel = " {" + weight_rel + ", " + val_rel + "}"
-        elif weight_rel:
-            rel = " {" + weight_rel + "}"
-        elif val_rel:
-            rel = " {" + val_rel + "}"
-        query = "WITH $batch as batch " \
-                "UNWIND batch as record " \
-                "MATCH (a" + sourcetype + " {name:record.source}), (b:Property {name:record.name}) " \
-                "MERGE (a)-[r:QUALITY_OF" + rel + "]->(b) " \
-                "RETURN type(r)"
+        # the relationship properties are the same for every record,
+        # so only the first record needs to be checked
+        rel_keys = tuple(key for key in ('weight', 'value') if key in property_query_dict[0])
+        query = _connect_property_query(sourcetype, rel_keys)
         _run_subbatch(tx, query, property_query_dict)
 
     @staticmethod
-    def _create_observations(tx, observations):
+    def _create_observations(session, observations):
         """
         Creates relationships between taxa and samples
         that represent the count number of that taxon in a sample.
-        :param tx: Neo4j transaction
+        Each taxon and sample pair occurs once in a BIOM table,
+        so the relationships are created instead of merged.
+        This assumes that the experiment is not in the database yet;
+        to upload it again, run delete_biom first.
+        The batch is committed on the server in chunks of 10000 rows;
+        this requires Neo4j 4.4 or later and is only allowed in auto-commit transactions,
+        so the query runs on the session directly.
+        :param session: Neo4j session
         :param observations: A list of dictionaries containing taxon name, sample ID and count.
         :return:
         """
-        query = "WITH $batch as batch " \
-                "UNWIND batch as record " \
-                "MATCH (a:Taxon {name: record.taxon}), (b:Specimen {name: record.sample}) " \
-                "MERGE (a)-[r:LOCATED_IN {count: record.value}]->(b) " \
-                "RETURN type(r)"
-        _run_subbatch(tx, query, observations)
+        session.run("UNWIND $batch as record "
+                    "CALL { WITH record "
+                    "MATCH (a:Taxon {name: record.taxon}), (b:Specimen {name: record.sample}) "
+                    "CREATE (a)-[:LOCATED_IN {count: record.value}]->(b) "
+                    "} IN TRANSACTIONS OF 10000 ROWS", batch=observations).consume()
 
     @staticmethod
-    def _samples_to_delete(tx, exp_id):
+    def _delete_observations(session, observations):
         """
-        Generates a list of sample nodes linked to the experiment node that needs to be deleted.
-        :param tx:
-        :param exp_id: ID of experiment node
+        Deletes the relationships between the taxa and samples of a batch of observations.
+        Chunks that were committed before _create_observations failed
+        are removed this way, so a retry does not duplicate them.
+        :param session: Neo4j session
+        :param observations: A list of dictionaries containing taxon name, sample ID and count.
         :return:
         """
-        names = tx.run(("MATCH (a:Specimen)-[r]-(b:Experiment) "
-                        "WHERE b.name = '" + exp_id +
-                        "' RETURN a.name")).data()
-        return names
+        session.run("UNWIND $batch as record "
+                    "CALL { WITH record "
+                    "MATCH (:Taxon {name: record.taxon})-[r:LOCATED_IN]->(:Specimen {name: record.sample}) "
+                    "DELETE r "
+                    "} IN TRANSACTIONS OF 10000 ROWS", batch=observations).consume()
 
     @staticmethod
-    def _taxa_to_delete(tx):
+    def _delete_experiment(tx, exp_id):
         """
-        After deleting samples, some taxa will no longer
-        be present in any experiment. These disconnected taxa need to be removed
-        and this function generates the list that does this.
-        :param tx:
+        Deletes the Experiment node.
+        :param tx: Neo4j transaction
+        :param exp_id: Name of Experiment node
         :return:
         """
-        names = tx.run("MATCH (a:Taxon) WHERE NOT (a)--(:Specimen) RETURN a.name").data()
-        return names
+        tx.run("MATCH (a:Experiment {name: $exp_id}) DETACH DELETE a", exp_id=exp_id)
 
     @staticmethod
-    def _delete_sample(tx, deletion_dict):
+    def _retry_transient(func, *args, attempts=3, cleanup=None):
         """
-        Deletes a sample node and all the observations linked to the sample.
-        Only samples present in a single experiment are deleted.
-        :param tx:
-        :param deletion_dict: List of dictionaries containing sample + experiment ID
+        Runs a batched query and retries it if a batch fails
+        with a transient error, such as a deadlock.
+        Most batched queries are idempotent,
+        so a retry only changes what the failed attempt did not commit.
+        Other queries need a cleanup function,
+        which removes what the failed attempt did commit before the retry.
+        :param func: Function that runs a batched query on a session
+        :param args: Arguments for the function
+        :param attempts: Maximum number of attempts
+        :param cleanup: Function that takes the same arguments and undoes a failed attempt
         :return:
         """
-        query = "WITH $batch as batch " \
-                "UNWIND batch as record " \
-                "MATCH (a:Specimen {name:record.sample})--(b:Experiment {name:record.exp_id}) " \
-                "DETACH DELETE a"
-        _run_subbatch(tx, query, deletion_dict)
+        for attempt in range(attempts):
+            try:
+                return func(*args)
+            except TransientError:
+                if attempt == attempts - 1:
+                    raise
+                logger.warning("Transient error, retrying...")
+                if cleanup:
+                    cleanup(*args)
 
     @staticmethod
-    def _delete_taxon(tx, deletion_dict):
+    def _delete_sample(session, exp_id):
         """
-        Deletes a taxon and all the edges linked to the taxon.
-        :param tx:
-        :param deletion_dict: List of dictionaries containing taxon identifiers
+        Deletes the sample nodes linked to an experiment
+        and all the observations linked to these samples.
+        The deletion is batched on the server,
+        so large experiments are not deleted in a single transaction.
+        :param session: Neo4j session
+        :param exp_id: Name of Experiment node
         :return:
         """
-        query = "WITH $batch as batch " \
-                "UNWIND batch as record " \
-                "MATCH (a:Taxon {name:record.taxon})--(b:Edge) " \
-                "DETACH DELETE b"
-        _run_subbatch(tx, query, deletion_dict)
-        query = "WITH $batch as batch " \
-                "UNWIND batch as record " \
-                "MATCH (a:Taxon {name:record.taxon}) " \
-                "DETACH DELETE a"
-        _run_subbatch(tx, query, deletion_dict)
+        session.run("MATCH (a:Specimen)--(b:Experiment {name: $exp_id}) "
+                    "CALL { WITH a DETACH DELETE a } IN TRANSACTIONS OF 10000 ROWS",
+                    exp_id=exp_id).consume()
+
+    @staticmethod
+    def _delete_taxon(session):
+        """
+        After deleting samples, some taxa will no longer
+        be present in any experiment. These disconnected taxa
+        and all the edges linked to them are deleted.
+        The deletion is batched on the server,
+        and each taxon is deleted in the same batch as its edges.
+        :param session: Neo4j session
+        :return:
+        """
+        session.run("MATCH (a:Taxon) WHERE NOT (a)--(:Specimen) "
+                    "CALL { WITH a "
+                    "OPTIONAL MATCH (a)--(b:Edge) "
+                    "WITH a, collect(b) as edges "
+                    "FOREACH (b IN edges | DETACH DELETE b) "
+                    "DETACH DELETE a } IN TRANSACTIONS OF 10000 ROWS").consume()
+
+    @staticmethod
+    def _missing_constraints(tx, labels):
+        """
+        Returns the labels that do not have a unique constraint on name.
+        :param tx: Neo4j transaction
+        :param labels: List of node labels
+        :return: List of node labels
+        """
+        constraints = tx.run("SHOW CONSTRAINTS YIELD type, labelsOrTypes, properties "
+                             "RETURN type, labelsOrTypes, properties").data()
+        constrained = {x['labelsOrTypes'][0] for x in constraints
+                       if 'UNIQUE' in x['type'] and x['properties'] == ['name']}
+        return [x for x in labels if x not in constrained]
+
+    @staticmethod
+    def _name_indices(tx, labels):
+        """
+        Returns the names of indices on name for the given labels
+        that do not belong to a constraint.
+        :param tx: Neo4j transaction
+        :param labels: List of node labels
+        :return: List of index names
+        """
+        indices = tx.run("SHOW INDEXES YIELD name, labelsOrTypes, properties, owningConstraint "
+                         "RETURN name, labelsOrTypes, properties, owningConstraint").data()
+        return [x['name'] for x in indices
+                if x['labelsOrTypes'] and x['labelsOrTypes'][0] in labels
+                and x['properties'] == ['name'] and x['owningConstraint'] is None]
 
     @staticmethod
     def _create_indices(tx):
         """
-        (Re)creates indices for specimen, taxon and property nodes.
-        This speeds up queries that connect such nodes.
+        Creates indices for specimen, taxon, property and taxonomy nodes
+        if they do not exist yet.
+        This speeds up the MERGE queries that create and connect such nodes,
+        so the indices need to be created before any of those queries are run.
         :param tx:
         :return:
         """
-        constraints = tx.run("CALL db.indexes() YIELD labelsOrTypes, properties "
-                             "RETURN labelsOrTypes, properties").data()
-        constraint_tuples = list()
-        for val in constraints:
-            if len(val['labelsOrTypes']) > 0 and 'name' in val['properties']:
-                constraint_tuples.append((val['labelsOrTypes'][0],
-                                      'name'))
-        if ('Property', 'name') in constraint_tuples:
-            tx.run("DROP INDEX on :Property(name)")
-        if ('Specimen', 'name') in constraint_tuples:
-            tx.run("DROP INDEX on :Specimen(name)")
-        if ('Taxon', 'name') in constraint_tuples:
-            tx.run("DROP INDEX on :Taxon(name)")
-        tx.run("CREATE INDEX on :Property(name)")
-        tx.run("CREATE INDEX on :Specimen(name)")
-        tx.run("CREATE INDEX on :Taxon(name)")
+        _create_name_indices(tx, ['Experiment', 'Property', 'Specimen', 'Taxon'] + _tax_levels)
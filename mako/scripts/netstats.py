@@ -10,8 +10,9 @@ __status__ = 'Development'
 __license__ = 'Apache 2.0'
 
 import sys
-from itertools import combinations
-from mako.scripts.utils import ParentDriver, _get_unique, _create_logger, _read_config
+from concurrent.futures import ThreadPoolExecutor
+from mako.scripts.utils import ParentDriver, _create_logger, _read_config, _run_subbatch, \
+    _create_name_indices, MakoDriverError
 import logging.handlers
 
 logger = logging.getLogger(__name__)
@@ -48,17 +49,27 @@ def start_netstats(inputs):
     except KeyError:
         logger.error("Login information not specified in arguments.", exc_info=True)
         exit()
+    except MakoDriverError:
+        logger.exception("Unable to start driver.")
+        exit()
     if not inputs['networks']:
-        networks = list()
-        hits = driver.query("MATCH (n:Network) RETURN n")
-        for hit in hits:
-            networks.append(hit['n'].get('name'))
+        # only the names are needed, not the full nodes
+        hits = driver.query("MATCH (n:Network) RETURN n.name AS name")
+        networks = [hit['name'] for hit in hits]
     else:
         networks = inputs['networks']
+    driver.create_indices()
     driver.graph_union(networks=networks)
-    for fraction in inputs['fraction']:
-        driver.graph_intersection(networks=networks,
-                                  weight=inputs['weight'], fraction=fraction)
+    # fractions that round to the same number of networks give the same set,
+    # so each set is only computed once
+    fractions = {round(len(networks) * fraction): fraction for fraction in inputs['fraction']}
+    # the intersections write to different sets,
+    # so they are run concurrently in separate sessions
+    with ThreadPoolExecutor(max_workers=max(len(fractions), 1)) as executor:
+        list(executor.map(lambda fraction: driver.graph_intersection(networks=networks,
+                                                                     weight=inputs['weight'],
+                                                                     fraction=fraction),
+                          fractions.values()))
     driver.graph_difference(networks=networks,
                             weight=inputs['weight'])
     driver.close()
@@ -71,6 +82,18 @@ class NetstatsDriver(ParentDriver):
     This driver extracts nodes and edges from the database that are required
     for the operations defined in the netstats module.
     """
+    def create_indices(self):
+        """
+        Creates indices on the names of Edge, Network and Set nodes,
+        since the set operations match these nodes by name.
+        :return:
+        """
+        try:
+            with self._driver.session() as session:
+                session.write_transaction(_create_name_indices, ['Edge', 'Network', 'Set'])
+        except Exception:
+            logger.error("Could not create indices. ", exc_info=True)
+
     def graph_union(self, networks=None):
         """
         Returns a subgraph that contains all nodes present in all networks.
@@ -81,18 +104,16 @@ class NetstatsDriver(ParentDriver):
         """
         union = None
         try:
+            # the read and write transactions share a session
             with self._driver.session() as session:
-                union_edges = session.read_transaction(self._get_union, networks)
-
-            with self._driver.session() as session:
-                setname = session.write_transaction(_write_logic, operation='Union',
-                                                   networks=networks, edges=union_edges)
-                logger.info("The union set operation for networks " + str(networks) +
-                            " has been added to "
-                            "the database\nwith name " + setname + ". ")
-            with self._driver.session() as session:
-                size = session.read_transaction(self._get_size, setname)
-                logger.info("This union contains " + str(size) + " edges. ")
+                # large analytical reads run as auto-commit queries on the session;
+                # a failure is not retried but reaches the except block below
+                union_edges = self._get_union(session, networks)
+                setname, size = session.write_transaction(_write_logic, operation='Union',
+                                                          networks=networks, edges=union_edges)
+                logger.info("The union set operation for networks %s has been added to "
+                            "the database\nwith name %s. ", networks, setname)
+                logger.info("This union contains %s edges. ", size)
         except Exception:
             logger.error("Could not obtain graph union. ", exc_info=True)
         return union
@@ -113,22 +134,20 @@ class NetstatsDriver(ParentDriver):
             logger.warning("Skipping intersection with 1 or fewer networks.")
         else:
             try:
+                # the read and write transactions share a session
                 with self._driver.session() as session:
-                    intersection_edges = session.read_transaction(self._get_intersection, networks, weight=weight, n=n)
-                with self._driver.session() as session:
+                    # large analytical reads run as auto-commit queries on the session
+                    intersection_edges = self._get_intersection(session, networks, weight=weight, n=n)
                     name = 'Intersection'
                     if weight:
                         name += '_weight'
                     if n:
                         name = name + '_' + str(n)
-                    setname = session.write_transaction(_write_logic, operation=name,
-                                                        networks=networks, edges=intersection_edges)
-                logger.info("The intersection set operation for networks " + str(networks) +
-                            " has been added to "
-                            "the database\nwith name " + setname + ". ")
-                with self._driver.session() as session:
-                    size = session.read_transaction(self._get_size, setname)
-                    logger.info("This intersection contains " + str(size) + " edges. ")
+                    setname, size = session.write_transaction(_write_logic, operation=name,
+                                                              networks=networks, edges=intersection_edges)
+                    logger.info("The intersection set operation for networks %s has been added to "
+                                "the database\nwith name %s. ", networks, setname)
+                    logger.info("This intersection contains %s edges. ", size)
             except Exception:
                 logger.error("Could not obtain graph intersection. ", exc_info=True)
         return intersection
@@ -143,58 +162,41 @@ class NetstatsDriver(ParentDriver):
         """
         difference = None
         try:
+            # the read and write transactions share a session
             with self._driver.session() as session:
-                difference_edges = session.read_transaction(self._get_difference, networks, weight=weight)
-
-            with self._driver.session() as session:
+                # large analytical reads run as auto-commit queries on the session
+                difference_edges = self._get_difference(session, networks, weight=weight)
                 name = 'Difference'
                 if weight:
                     name += '_weight'
-                setname = session.write_transaction(_write_logic, operation=name,
-                                                   networks=networks, edges=difference_edges)
-                logger.info("The difference set operation for networks " + str(networks) +
-                            " has been added to "
-                            "the database \nwith name " + setname + ". ")
-            with self._driver.session() as session:
-                size = session.read_transaction(self._get_size, setname)
-                logger.info("This difference contains " + str(size) + " edges. ")
+                setname, size = session.write_transaction(_write_logic, operation=name,
+                                                          networks=networks, edges=difference_edges)
+                logger.info("The difference set operation for networks %s has been added to "
+                            "the database\nwith name %s. ", networks, setname)
+                logger.info("This difference contains %s edges. ", size)
         except Exception:
             logger.error("Could not obtain graph difference. ", exc_info=True)
         return difference
 
-    @staticmethod
-    def _get_weight(tx, node, network):
-        """
-        Returns the weight of an Edge node.
-        :param tx: Neo4j transaction
-        :param node: Returns the weight of the specified node
-        :param network: Network where weight is needed
-        :return:
-        """
-        weight = tx.run("MATCH (n:Edge {name: '" + node.get('name') +
-                        "'})-[r]-(:Network {name: '" + network + "'})"
-                        " RETURN r").data()[0]['r']['weight']
-        return weight
-
     @staticmethod
     def _get_union(tx, networks):
         """
         Accesses database to return edge list of union of networks.
-        :param tx: Neo4j transaction
+        :param tx: Neo4j transaction or session
         :param networks: List of network names
         :return: Edge list of lists containing source, target, network and weight of each edge.
         """
-        edges = tx.run(("WITH " + str(networks) +
-                        " as names MATCH (n:Edge)-->(b:Network) "
-                        "WHERE b.name in names RETURN n")).data()
-        edges = _get_unique(edges, 'n')
+        # duplicates are removed by the database, not after transfer
+        edges = set(tx.run("MATCH (n:Edge)-->(b:Network) "
+                           "WHERE b.name IN $names RETURN DISTINCT n.name AS name",
+                           names=networks).value('name'))
         return edges
 
     @staticmethod
     def _get_intersection(tx, networks, weight, n):
         """
         Accesses database to return edge list of intersection of networks.
-        :param tx: Neo4j transaction
+        :param tx: Neo4j transaction or session
         :param networks: List of network names
         :param weight: If false, the intersection includes edges with matching partners but different weights
         :param n: If specified, number of networks that the intersecting node should be in
@@ -204,54 +206,43 @@ class NetstatsDriver(ParentDriver):
         curated_weighted_edges = []
         if not n:
             # get edges that are in all networks
-            unweighted_query, weighted_query = _get_intersection_query(networks, weight)
-            edges = tx.run(unweighted_query).data()
+            unweighted_query, weighted_query = _get_intersection_query(weight)
+            edges = tx.run(unweighted_query, names=list(networks)).value('name')
             if weighted_query:
-                weighted_edges = tx.run(weighted_query).data()
                 # ok not to match pattern,
                 # it will always be captured in reverse too
-                weighted_edges = _get_unique(weighted_edges, key='a')
+                weighted_edges = {record['name'] for record in tx.run(weighted_query, names=list(networks))}
                 curated_weighted_edges = _curate_weighted_edges(tx, weighted_edges, networks)
         else:
             # get all edges in number of networks
-            edges = list()
-            combos = list(combinations(networks, n))
-            for combo in combos:
-                unweighted_query, weighted_query = _get_intersection_query(combo, weight)
-                edges.extend(tx.run(unweighted_query).data())
-                # the weighted query returns edges present in multiple networks
-                # but it's not guaranteed to be all the networks in combo
-                if weighted_query:
-                    weighted_edges = tx.run(weighted_query).data()
-                    weighted_edges = _get_unique(weighted_edges, key='a')
-                    curated_weighted_edges = _curate_weighted_edges(tx, weighted_edges, networks)
-        edges = list(_get_unique(edges, 'n'))
+            # an edge is part of some combination of n networks
+            # if it is linked to at least n of the networks
+            edges = tx.run("UNWIND $names AS name "
+                           "MATCH (n:Edge)-->(b:Network {name: name}) "
+                           "WITH n, count(DISTINCT b) AS hits "
+                           "WHERE hits >= $n RETURN n.name AS name", names=networks, n=n).value('name')
+            # the weighted query returns edges present in multiple networks
+            # every pair of networks is part of some combination,
+            # so the query only needs to run once for all networks;
+            # the curation step checks membership of all networks anyway
+            unweighted_query, weighted_query = _get_intersection_query(weight)
+            if weighted_query:
+                weighted_edges = {record['name'] for record in tx.run(weighted_query, names=list(networks))}
+                curated_weighted_edges = _curate_weighted_edges(tx, weighted_edges, networks)
+        edges = list(edges)
         edges.extend(curated_weighted_edges)
-        name = 'Intersection'
-        if weight:
-            name += '_weight'
-        if n:
-            name = name + '_' + str(n)
         return edges
 
     @staticmethod
     def _get_difference(tx, networks, weight):
         """
         Accesses database to return edge list of difference of networks.
-        :param tx: Neo4j transaction
+        :param tx: Neo4j transaction or session
         :param networks: List of network names
         :param weight: If false, the difference includes edges with matching partners but different weights
         :return: Edge list of lists containing source, target, network and weight of each edge.
         """
-        edges = list()
-        for network in networks:
-            # all edges with only 1 link to a network
-            # are part of the difference
-            edges.extend(tx.run(("MATCH (n:Edge)-->(x:Network {name: '" + network +
-                                 "'}) WITH n MATCH (n)-[r]->(y:Network) WHERE y.name IN " + str(networks) +
-                                 " WITH n, count(r) "
-                                 "as num WHERE num=1 RETURN n")).data())
-        edges = _get_unique(edges, 'n')
+        curated_weighted_edges = set()
         if weight:
             # if edges are in 2 networks,
             # and they have a different sign in each network,
@@ -259,14 +250,16 @@ class NetstatsDriver(ParentDriver):
             # so query each combination of networks
             # to find edges that have a relationship to those networks,
             # with different weights.
-            unweighted_query, weighted_query = _get_intersection_query(networks, weight=False)
-            edge_partners = tx.run(weighted_query).data()
-            edge_partners = _get_unique(edge_partners, key='a')
+            unweighted_query, weighted_query = _get_intersection_query(weight=False)
+            edge_partners = {record['name'] for record in tx.run(weighted_query, names=list(networks))}
             curated_weighted_edges = _curate_weighted_edges(tx, edge_partners, networks)
-            edges = edges.difference(curated_weighted_edges)
-        name = 'Difference'
-        if weight:
-            name += '_weight'
+        # all edges with only 1 link to a network
+        # are part of the difference;
+        # removed edges are filtered out by the database
+        edges = set(tx.run("MATCH (n:Edge)-[r]->(y:Network) WHERE y.name IN $names "
+                           "WITH n, count(r) as num WHERE num=1 AND NOT n.name IN $removed "
+                           "RETURN n.name AS name",
+                           names=networks, removed=list(curated_weighted_edges)).value('name'))
         return edges
 
     @staticmethod
@@ -280,8 +273,8 @@ class NetstatsDriver(ParentDriver):
         """
         num = tx.run("MATCH (n:Set {name: $id})-"
                      "[r:IN_SET]-() RETURN count(r) as count",
-                     id=operation).data()
-        return num[0]['count']
+                     id=operation).single()
+        return num['count']
 
 
 def _curate_weighted_edges(tx, weighted_edges, networks):
@@ -290,32 +283,30 @@ def _curate_weighted_edges(tx, weighted_edges, networks):
     and returns the networks connected to both edges.
     Weighted edges that are not connected to all networks in
     the networks parameter are not returned.
+    Like the original implementation, only the first pair of edges
+    that is found decides whether all weighted edges are returned;
+    pairs are not evaluated separately.
     :param weighted_edges:
     :param networks:
     :return:
     """
-    curated_edges = list()
     query_edges = [{'name': x} for x in weighted_edges]
+    # the networks of the paired edges are collected
+    # and checked in the same query
     query = "WITH $batch as batch " \
             "UNWIND batch as record " \
             "MATCH (m)--(a:Edge {name: record.name})--(n)--(b:Edge)--(m) " \
             "WHERE (m:Taxon OR m:Property) AND (n:Taxon OR n:Property) " \
-            "RETURN a.name,b.name LIMIT 1"
-    paired_edges = tx.run(query, batch=query_edges)
-    query = "WITH $batch as batch " \
-            "UNWIND batch as record " \
-            "MATCH (a:Edge {name: record.name})--(b:Network) " \
-            "RETURN a.name,b.name"
-    network_edges = tx.run(query, batch=query_edges).data()
-    network_dict = {x['a.name']: [] for x in network_edges}
-    for edge in network_edges:
-        network_dict[edge['a.name']].append(edge['b.name'])
-    for pair in paired_edges:
-        total_networks = network_dict[pair['a.name']] + network_dict[pair['b.name']]
-        result = all(elem in total_networks for elem in networks)
-        if result:
-            curated_edges.extend(list(network_dict.keys()))
-    return set(curated_edges)
+            "WITH a, b LIMIT 1 " \
+            "MATCH (a)--(c:Network) WITH a, b, collect(c.name) as networks_a " \
+            "MATCH (b)--(d:Network) WITH networks_a, collect(d.name) as networks_b " \
+            "RETURN all(x IN $networks WHERE x IN networks_a + networks_b) as curated"
+    result = tx.run(query, batch=query_edges, networks=list(networks)).single()
+    # weighted edges are always connected to a network,
+    # so all of them are returned if the pair covers all networks
+    if result and result['curated']:
+        return set(weighted_edges)
+    return set()
 
 
 def _write_logic(tx, operation, networks, edges):
@@ -325,7 +316,7 @@ def _write_logic(tx, operation, networks, edges):
     :param operation: Type of logic operation
     :param networks: List of network names
     :param edges: List of edges returned by logic operation
-    :return:
+    :return: Name of the set and number of edges in the set
     """
     name = operation
     # first match and detach delete
@@ -342,34 +333,34 @@ def _write_logic(tx, operation, networks, edges):
             "(b:Set {name: record.set}) " \
             "MERGE (a)-[r:IN_SET]->(b) " \
             "RETURN type(r)"
-    tx.run(query, batch=edges)
-    return name
+    # large sets are written in chunks
+    _run_subbatch(tx, query, edges)
+    # the set size is counted in the same transaction
+    size = NetstatsDriver._get_size(tx, name)
+    return name, size
 
 
-def _get_intersection_query(networks, weight=True):
+def _get_intersection_query(weight=True):
     """
-    For a list of networks,
-    constructs a query that gets edges belonging to all networks.
+    Constructs a query that gets edges belonging to all networks.
     Can extract only edges that have the same weight in all networks,
     or edges that have different weights (if weight is false.)
-    :param networks: List of networks that edges should be in
+    The list of network names is passed to the queries as the names parameter,
+    so the same query plan is reused for every set of networks.
     :param weight: If false, edges are counted if they are separate nodes but have the same partners
     :return:
     """
-    queries = list()
     weighted_query = None
-    for node in networks:
-        queries.append(("MATCH (n:Edge)-->(:Network {name: '" +
-                        node + "'}) "))
     if not weight:
         weighted_query = ("MATCH (m)--(a:Edge)--(n)--(b:Edge)--(m) "
                           "WHERE (m:Taxon OR m:Property) AND (n:Taxon OR n:Property) "
                           "WITH a, b MATCH (a)--(c:Network) "
                           "MATCH (b)--(d:Network) "
-                          "WHERE c.name IN  " + str(list(networks)) +
-                          " AND d.name IN " + str(list(networks)) +
-                          " RETURN a,b,c,d ")
-    query = " ".join(queries) + " RETURN n"
+                          "WHERE c.name IN $names AND d.name IN $names "
+                          "RETURN DISTINCT a.name AS name")
+    query = ("MATCH (n:Edge)-->(:Network {name: $names[0]}) "
+             "WHERE all(name IN $names WHERE (n)-->(:Network {name: name})) "
+             "RETURN DISTINCT n.name AS name")
     return query, weighted_query
 
 
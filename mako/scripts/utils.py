@@ -10,12 +10,17 @@ __license__ = 'Apache 2.0'
 
 import sys
 import os
+import tempfile
 import mako
 import logging
 import logging.handlers
+from functools import lru_cache
 from neo4j import GraphDatabase
 logger = logging.getLogger(__name__)
 
+# maximum number of records sent in a single UNWIND query
+_subbatch_size = 10000
+
 
 def _get_unique(node_list, key, mode=None):
     """
@@ -25,10 +30,7 @@ def _get_unique(node_list, key, mode=None):
     :param mode: If 'num', the number of unique nodes is returned.
     :return: Unique nodes (list of nodes) or node number
     """
-    unique_samples = list()
-    for item in node_list:
-        unique_samples.append(item[key].get('name'))
-    unique_samples = set(unique_samples)
+    unique_samples = {item[key].get('name') for item in node_list}
     if mode == 'num':
         unique_samples = len(unique_samples)
     return unique_samples
@@ -42,14 +44,43 @@ def _create_logger(filepath):
     :return:
     """
     logpath = filepath + '/mako.log'
+    # every driver calls this function,
+    # so the handler is only added if the log file does not have one yet
+    if any(isinstance(h, logging.handlers.MemoryHandler) and
+           h.target.baseFilename == os.path.abspath(logpath) for h in logger.handlers):
+        return
     # filelog path is one folder above mako
     # pyinstaller creates a temporary folder, so log would be deleted
-    fh = logging.handlers.RotatingFileHandler(maxBytes=500,
+    fh = logging.handlers.RotatingFileHandler(maxBytes=5000000, backupCount=3,
                                               filename=logpath, mode='a')
     fh.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     fh.setFormatter(formatter)
-    logger.addHandler(fh)
+    # records are buffered and written in chunks,
+    # errors are written immediately
+    mh = logging.handlers.MemoryHandler(capacity=1024, flushLevel=logging.ERROR,
+                                        target=fh, flushOnClose=True)
+    mh.setLevel(logging.INFO)
+    logger.addHandler(mh)
+
+
+def _flush_logger(clear=False):
+    """
+    Writes the log records that are buffered in memory to the log file.
+    Processes forked by a pool inherit the buffer of the parent process,
+    so these should clear it instead to prevent duplicate records.
+    :param clear: If true, buffered records are discarded instead of written.
+    :return:
+    """
+    for handler in logger.handlers:
+        if clear and isinstance(handler, logging.handlers.MemoryHandler):
+            handler.acquire()
+            try:
+                handler.buffer.clear()
+            finally:
+                handler.release()
+        else:
+            handler.flush()
 
 
 def _resource_path(relative_path):
@@ -59,6 +90,16 @@ def _resource_path(relative_path):
     :param relative_path: Path to MEI location.
     :return:
     """
+    return os.path.join(_base_path(), relative_path)
+
+
+@lru_cache(maxsize=None)
+def _base_path():
+    """
+    Finds the mako folder once per process,
+    since it does not change while mako is running.
+    :return: Path to the mako folder
+    """
     try:
         # PyInstaller creates a temp folder and stores path in _MEIPASS
         base_path = list(mako.__path__)[0]
@@ -70,7 +111,7 @@ def _resource_path(relative_path):
         splitpath = splitpath[0].split(sep='/')
     if splitpath[-1] == splitpath[-2]:
         base_path = os.path.abspath(base_path + "\\..")
-    return os.path.join(base_path, relative_path)
+    return base_path
 
 
 def _read_config(args):
@@ -84,14 +125,13 @@ def _read_config(args):
     :return: Neo4j credentials
     """
     config = dict()
+    config_fp = args['fp'] + '//' + 'config'
     try:
-        with open(args['fp'] + '//' + 'config', 'r') as file:
-            # read a list of lines into data
-            configfile = file.readlines()
-        for line in configfile[2:]:
-            key = line.split(':')[0]
-            val = line.split(' ')[-1].strip()
-            config[key] = val
+        # read a list of lines into data
+        stat = os.stat(config_fp)
+        configfile, settings = _load_config(config_fp, (stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        configfile = list(configfile)
+        config = dict(settings)
     except FileNotFoundError:
         config = {'pid': 'None',
                   'address': 'None',
@@ -99,35 +139,61 @@ def _read_config(args):
                   'username': 'None'}
         configfile = ["# This file contains the PID and login details of the Neo4j console.\n",
                    "# If there is no PID specified, the 3rd line should state None.\n"]
-        with open(args['fp'] + '//' + 'config', 'w') as file:
-            for line in config:
-                newline = line + ': ' + str(config[line]) + '\n'
-                configfile.append(newline)
-            file.writelines(configfile)
+        for line in config:
+            newline = line + ': ' + str(config[line]) + '\n'
+            configfile.append(newline)
+        _write_config(config_fp, configfile)
     if len(config) == 0:
         logger.error('Config file is empty. \n')
-    for key in set(config.keys()).intersection(args.keys()):
+    for key in config:
         if key in args:
             if args[key]:
                 config[key] = args[key]
-        if config[key] == 'None':
-            logger.error('Could not read login information from config or from arguments. \n')
-    with open(args['fp'] + '//' + 'config', 'w') as file:
-        newlines = configfile[:3]
-        if args['store_config']:
-            for line in configfile[3:]:
-                key = line.split(':')[0]
-                newline = key + ': ' + config[key] + '\n'
-                newlines.append(newline)
-        else:
-            for line in configfile[3:]:
-                key = line.split(':')[0]
-                newline = key + ': None' + '\n'
-                newlines.append(newline)
-        file.writelines(newlines)
+            if config[key] == 'None':
+                logger.error('Could not read login information from config or from arguments. \n')
+    newlines = configfile[:3]
+    for line in configfile[3:]:
+        key = line.split(':')[0]
+        newlines.append(key + ': ' + (config[key] if args['store_config'] else 'None') + '\n')
+    # the file is only rewritten if the settings changed
+    if newlines != configfile:
+        _write_config(config_fp, newlines)
     return config
 
 
+def _write_config(config_fp, lines):
+    """
+    Writes the mako config file.
+    The lines are written to a temporary file that then replaces the config file,
+    so a process reading the config file never sees it half-written.
+
+    :param config_fp: Filepath to config file
+    :param lines: List of lines to write
+    :return:
+    """
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(config_fp),
+                                     delete=False) as file:
+        file.write(''.join(lines))
+    os.replace(file.name, config_fp)
+
+
+@lru_cache(maxsize=8)
+def _load_config(config_fp, stamp):
+    """
+    Reads and parses the lines of the mako config file.
+    The inode, modification time and size are part of the cache key,
+    so the file is read again after it has been rewritten.
+
+    :param config_fp: Filepath to config file
+    :param stamp: Tuple of inode, modification time and size of config file
+    :return: Tuple of lines in the config file and tuple of key, value pairs
+    """
+    with open(config_fp, 'r') as file:
+        lines = tuple(file.readlines())
+    settings = tuple((line.split(':')[0], line.split(' ')[-1].strip()) for line in lines[2:])
+    return lines, settings
+
+
 def query(args, query):
     """
     Exports Neo4j query as logger info.
@@ -137,14 +203,17 @@ def query(args, query):
     :param result: Empty result query
     :return: None
     """
-    driver = ParentDriver(uri=args['address'],
-                          user=args['username'],
-                          password=args['password'],
-                          filepath=_resource_path(''),
-                          encrypted=args['encryption'])
-    result = driver.query(query)
-    logger.info(result)
-    driver.close()
+    with ParentDriver(uri=args['address'],
+                      user=args['username'],
+                      password=args['password'],
+                      filepath=_resource_path(''),
+                      encrypted=args['encryption']) as driver:
+        result = driver.query(query)
+    # results can contain thousands of records,
+    # so these are only written to the log when debugging
+    if logger.isEnabledFor(logging.INFO):
+        logger.info('Query returned %d records.', len(result) if result else 0)
+    logger.debug('%r', result)
     return result
 
 
@@ -157,14 +226,17 @@ def write_query(args, query):
     :param result: Empty result query
     :return: None
     """
-    driver = ParentDriver(uri=args['address'],
-                          user=args['username'],
-                          password=args['password'],
-                          filepath=_resource_path(''),
-                          encrypted=args['encryption'])
-    result = driver.write(query)
-    logger.info(result)
-    driver.close()
+    with ParentDriver(uri=args['address'],
+                      user=args['username'],
+                      password=args['password'],
+                      filepath=_resource_path(''),
+                      encrypted=args['encryption']) as driver:
+        result = driver.write(query)
+    # results can contain thousands of records,
+    # so these are only written to the log when debugging
+    if logger.isEnabledFor(logging.INFO):
+        logger.info('Query returned %d records.', len(result) if result else 0)
+    logger.debug('%r', result)
     return result
 
 
@@ -193,28 +265,57 @@ def _get_path(path, default):
     return checked_path
 
 
-def _run_subbatch(tx, query, query_dict):
+def _create_name_indices(tx, labels):
+    """
+    Creates indices on the name property of the given node labels,
+    so MATCH and MERGE queries on names do not scan all nodes.
+    Labels that already have an index on name,
+    including the indices behind the unique constraints set by the base module,
+    are skipped.
+
+    :param tx: Neo4j transaction
+    :param labels: List of node labels
+    :return:
+    """
+    indices = tx.run("SHOW INDEXES YIELD labelsOrTypes, properties "
+                     "RETURN labelsOrTypes, properties").data()
+    indexed = {val['labelsOrTypes'][0] for val in indices
+               if val['labelsOrTypes'] and val['properties'] == ['name']}
+    for label in labels:
+        if label not in indexed:
+            tx.run("CREATE INDEX IF NOT EXISTS FOR (n:" + label + ") ON (n.name)")
+
+
+def _run_subbatch(tx, query, query_dict, batch_size=_subbatch_size):
     """
     Batch queries can get so big that they cause memory issues.
     This function splits up the batches so this behaviour is avoided.
     While the apoc.periodic.commit could also fix this,
     the apoc JAR needs to be loaded first.
+    Very small batches need many round-trips to the database,
+    so the default batch size is 10000 records.
 
     :param tx: Neo4j handler
     :param query: String query to run
     :param query_dict: List of dictonaries that needs to be split to run well
+    :param batch_size: Maximum number of records per query
     :return:
     """
-    for i in range(0, len(query_dict), 100):
-        if i + 100 > len(query_dict):
-            subdict = query_dict[i:len(query_dict)]
-        else:
-            subdict = query_dict[i:i + 100]
-        tx.run(query, batch=subdict)
+    # slices past the end of the list are truncated, so the last batch needs no special case
+    for i in range(0, len(query_dict), batch_size):
+        tx.run(query, batch=query_dict[i:i + batch_size])
+
+
+class MakoDriverError(Exception):
+    """
+    Raised when a driver for the Neo4j database cannot be started.
+    """
+    pass
 
 
 class ParentDriver:
-    def __init__(self, uri, user, password, filepath, encrypted=True):
+    def __init__(self, uri, user, password, filepath, encrypted=True,
+                 pool_size=100, acquisition_timeout=60):
         """
         Initializes a driver for accessing the Neo4j database.
 
@@ -223,13 +324,22 @@ class ParentDriver:
         :param password: Password for Neo4j database
         :param filepath: Filepath where logs will be written.
         :param encrypted: Can be set to False to interact with Docker during testing
+        :param pool_size: Maximum number of connections in the connection pool
+        :param acquisition_timeout: Seconds to wait for a connection from the pool
         """
         _create_logger(filepath)
         try:
-            self._driver = GraphDatabase.driver(uri, auth=(user, password), encrypted=encrypted)
-        except Exception:
-            logger.error("Unable to start driver. \n", exc_info=True)
-            sys.exit()
+            self._driver = GraphDatabase.driver(uri, auth=(user, password), encrypted=encrypted,
+                                                max_connection_pool_size=pool_size,
+                                                connection_acquisition_timeout=acquisition_timeout)
+        except Exception as e:
+            raise MakoDriverError("Unable to start driver.") from e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def close(self):
         """
@@ -237,6 +347,7 @@ class ParentDriver:
         :return:
         """
         self._driver.close()
+        _flush_logger()
 
     def query(self, query, batch=None):
         """
@@ -11,11 +11,11 @@ __status__ = 'Development'
 __license__ = 'Apache 2.0'
 
 import sys
+from itertools import repeat
+from collections import ChainMap
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from mako.scripts.io import IoDriver
-from manta.cluster import cluster_graph
-from manta.reliability import perm_clusters
-from anuran.main import model_calcs
-from mako.scripts.utils import _create_logger, _read_config
+from mako.scripts.utils import _create_logger, _read_config, _flush_logger, MakoDriverError
 import logging.handlers
 import networkx as nx
 
@@ -55,19 +55,60 @@ def start_wrapper(inputs):
     except KeyError:
         logger.error("Login information not specified in arguments.", exc_info=True)
         exit()
+    except MakoDriverError:
+        logger.exception("Unable to start driver.")
+        exit()
     # get networks
     networks = driver.return_networks(inputs['networks'])
     # run manta
     if 'manta' in inputs:
-        for network in networks:
-            run_manta(inputs, network=networks[network], network_id=network, driver=driver)
+        if inputs.get('workers', 1) > 1:
+            # manta is cpu-bound, so networks are clustered in separate processes
+            login = {x: config[x] for x in ['address', 'username', 'password']}
+            # forked workers inherit buffered log records,
+            # so these are written before the pool starts
+            _flush_logger()
+            with ProcessPoolExecutor(max_workers=inputs['workers']) as executor:
+                list(executor.map(_run_manta_worker, repeat(inputs), repeat(login),
+                                  networks.values(), networks.keys()))
+        else:
+            # results are uploaded in the background while the next network is clustered,
+            # a single upload thread keeps the writes in order
+            uploads = []
+            with ThreadPoolExecutor(max_workers=1) as uploader:
+                for network in networks:
+                    uploads.extend(run_manta(inputs, network=networks[network], network_id=network,
+                                             driver=driver, uploader=uploader))
+            for upload in uploads:
+                upload.result()
     if 'anuran' in inputs:
         run_anuran(inputs, networks, driver)
     driver.close()
     logger.info('Completed netstats operations!  ')
 
 
-def run_manta(inputs, network, network_id, driver):
+def _run_manta_worker(inputs, login, network, network_id):
+    """
+    Runs manta in a separate process.
+    Neo4j drivers cannot be shared across processes,
+    so every worker opens its own driver.
+    :param inputs: Arguments for manta
+    :param login: Dictionary with Neo4j address, username and password
+    :param network: Network to cluster
+    :param network_id: Network ID
+    :return:
+    """
+    # records buffered by the parent process are written by the parent
+    _flush_logger(clear=True)
+    with IoDriver(uri=login['address'],
+                  user=login['username'],
+                  password=login['password'],
+                  filepath=inputs['fp'],
+                  encrypted=inputs['encryption']) as driver:
+        run_manta(inputs, network=network, network_id=network_id, driver=driver)
+
+
+def run_manta(inputs, network, network_id, driver, uploader=None):
     """
     Takes the extracted network object and runs manta.
     The manta results are then uploaded back to
@@ -76,9 +117,16 @@ def run_manta(inputs, network, network_id, driver):
     :param network: Network to cluster
     :param network_id: Network ID
     :param driver: Neo4j IO driver
-    :return:
+    :param uploader: Optional executor that uploads the results in the background
+    :return: List of futures for uploads submitted to the uploader
     """
-    network = nx.to_undirected(network)
+    # manta is only imported when it is used, since it is slow to import
+    from manta.cluster import cluster_graph
+    from manta.reliability import perm_clusters
+    # networks returned by the IO driver are already undirected,
+    # so they are only copied if they are directed
+    if network.is_directed():
+        network = nx.to_undirected(network)
     results = cluster_graph(network, limit=inputs['limit'], max_clusters=inputs['max'],
                             min_clusters=inputs['min'], min_cluster_size=inputs['ms'],
                             iterations=inputs['iter'], subset=inputs['subset'],
@@ -86,35 +134,43 @@ def run_manta(inputs, network, network_id, driver):
                             permutations=inputs['perm'], verbose=False)
     graph = results[0]
     # write to db
-    nodes = nx.get_node_attributes(graph, 'assignment')
-    if len(nodes) > 0:
-        # sometimes no assignment if the graph is balanced
-        for node in nodes:
-            node_dict = construct_manta(source=node, value=nodes[node], network_id=network_id)
-            driver.include_nodes(node_dict, name='Cluster', label='Taxon', verbose=False)
-    nodes = nx.get_node_attributes(graph, 'cluster')
-    for node in nodes:
-        node_dict = construct_manta(source=node, value=nodes[node], network_id=network_id)
-        driver.include_nodes(node_dict, name='Cluster', label='Taxon', verbose=False)
-
+    # sometimes no assignment if the graph is balanced
+    uploads = [_include_attribute(graph, 'assignment', 'Cluster', network_id, driver, uploader),
+               _include_attribute(graph, 'cluster', 'Cluster', network_id, driver, uploader)]
     if inputs['cr']:
         perm_clusters(graph=graph, limit=inputs['limit'], max_clusters=inputs['max'],
                       min_clusters=inputs['min'], min_cluster_size=inputs['ms'],
                       iterations=inputs['iter'], ratio=inputs['ratio'],
                       partialperms=inputs['perm'], relperms=inputs['rel'], subset=inputs['subset'],
                       error=inputs['error'], verbose=False)
-        nodes = nx.get_node_attributes(graph, 'lowerCI')
-        for node in nodes:
-            node_dict = construct_manta(source=node, value=nodes[node], network_id=network_id)
-            driver.include_nodes(node_dict, name='lowerCI', label='Taxon', verbose=False)
-        nodes = nx.get_node_attributes(graph, 'upperCI')
-        for node in nodes:
-            node_dict = construct_manta(source=node, value=nodes[node], network_id=network_id)
-            driver.include_nodes(node_dict, name='upperCI', label='Taxon', verbose=False)
-        nodes = nx.get_node_attributes(graph, 'widthCI')
-        for node in nodes:
-            node_dict = construct_manta(source=node, value=nodes[node], network_id=network_id)
-            driver.include_nodes(node_dict, name='widthCI', label='Taxon', verbose=False)
+        for attribute in ['lowerCI', 'upperCI', 'widthCI']:
+            uploads.append(_include_attribute(graph, attribute, attribute,
+                                              network_id, driver, uploader))
+    return [x for x in uploads if x is not None]
+
+
+def _include_attribute(graph, attribute, name, network_id, driver, uploader=None):
+    """
+    Uploads a manta node attribute for all nodes at once,
+    so the database is only accessed once per attribute.
+    The records are built right away,
+    so the graph can be changed while the upload is running.
+    :param graph: NetworkX graph with manta results
+    :param attribute: Node attribute to upload
+    :param name: Label of the nodes that are created for the attribute values
+    :param network_id: Network ID
+    :param driver: Neo4j IO driver
+    :param uploader: Optional executor that uploads the records in the background
+    :return: Future of the upload if an uploader is given
+    """
+    nodes = nx.get_node_attributes(graph, attribute)
+    if len(nodes) > 0:
+        node_dict = [{'source': node, 'target': network_id + ', cluster ' + str(value)}
+                     for node, value in nodes.items()]
+        if uploader:
+            return uploader.submit(driver.include_nodes, node_dict, name=name,
+                                   label='Taxon', verbose=False)
+        driver.include_nodes(node_dict, name=name, label='Taxon', verbose=False)
 
 
 def run_anuran(inputs, networks, driver):
@@ -127,35 +183,18 @@ def run_anuran(inputs, networks, driver):
     :param driver: Neo4j IO driver
     :return:
     """
+    # anuran is only imported when it is used, since it is slow to import
+    from anuran.main import model_calcs
     grouped_networks = [(name, networks[name]) for name in networks]
-    args = inputs.copy()
-    args['fp'] += '/anuran'
-    args['network'] = args['graph']
+    # anuran-specific arguments override the inputs without copying them
+    args = ChainMap({'fp': inputs['fp'] + '/anuran', 'network': inputs['graph']}, inputs)
     centralities = model_calcs(networks={'Neo4j': grouped_networks}, args=args)
     # add a node with the different centrality
     # give node properties with comparison value
     # add p value as relationship
-    if centralities:
-        for index, row in centralities.iterrows():
-            centrality_dict = {}
-            centrality_dict[row['Node']] = {}
-            centrality_dict[row['Node']]['target'] = row['Measure'] + ', ' + row['Comparison']
-            centrality_dict[row['Node']]['rel_property'] = [('pvalue', row['P'])]
-            if 'P.adj' in row:
-                centrality_dict[row['Node']]['rel_property'].append(('padj', row['P.adj']))
-            driver.include_nodes(centrality_dict, name='Centrality', label='Taxon', verbose=False)
-
-
-def construct_manta(source, value, network_id):
-    """
-    Constructs a dictionary from manta outputs that
-    can be imported into the Neo4j database.
-    :param source:
-    :param value:
-    :param network_id:
-    :return:
-    """
-    node_dict = {}
-    node_dict[source] = {}
-    node_dict[source]['target'] = network_id + ', cluster ' + str(value)
-    return node_dict
+    if centralities is not None and len(centralities) > 0:
+        columns = {'Node': 'source', 'P': 'pvalue', 'P.adj': 'padj'}
+        records = centralities[[x for x in columns if x in centralities.columns]].rename(columns=columns)
+        records['target'] = centralities['Measure'] + ', ' + centralities['Comparison']
+        centrality_dict = records.to_dict('records')
+        driver.include_nodes(centrality_dict, name='Centrality', label='Taxon', verbose=False)
@@ -8,12 +8,16 @@ The file first sets up a simple Neo4j database for carrying out the tests.
 import unittest
 import time
 import os
+import tempfile
+from unittest import mock
 import biom
 import pandas as pd
 import numpy as np
 from biom.cli.util import write_biom_table
-from mako.scripts.neo4biom import start_biom, Biom2Neo, read_taxonomy
-from mako.scripts.utils import _resource_path
+from neo4j.exceptions import TransientError
+from mako.scripts.neo4biom import start_biom, Biom2Neo, read_taxonomy, _cached_load_table, \
+    _read_metadata
+from mako.scripts.utils import _resource_path, _create_name_indices
 
 __author__ = 'Lisa Rottjers'
 __maintainer__ = 'Lisa Rottjers'
@@ -166,7 +170,10 @@ class TestNeo4Biom(unittest.TestCase):
                   'store_config': False,
                   'delete': None,
                   'encryption': False,
-                  'obs': True}
+                  'obs': True,
+                  'bulk': False,
+                  'workers': 1,
+                  'pool_size': 100}
         start_biom(inputs)
         driver = Biom2Neo(user=inputs['username'],
                           password=inputs['password'],
@@ -195,7 +202,10 @@ class TestNeo4Biom(unittest.TestCase):
                   'store_config': False,
                   'delete': None,
                   'encryption': False,
-                  'obs': True}
+                  'obs': True,
+                  'bulk': False,
+                  'workers': 1,
+                  'pool_size': 100}
         start_biom(inputs)
         driver = Biom2Neo(user=inputs['username'],
                           password=inputs['password'],
@@ -223,7 +233,10 @@ class TestNeo4Biom(unittest.TestCase):
                   'store_config': False,
                   'delete': None,
                   'encryption': False,
-                  'obs': True}
+                  'obs': True,
+                  'bulk': False,
+                  'workers': 1,
+                  'pool_size': 100}
         start_biom(inputs)
         driver = Biom2Neo(user=inputs['username'],
                           password=inputs['password'],
@@ -280,7 +293,10 @@ class TestNeo4Biom(unittest.TestCase):
                   'store_config': False,
                   'delete': ['test1'],
                   'encryption': False,
-                  'obs': True}
+                  'obs': True,
+                  'bulk': False,
+                  'workers': 1,
+                  'pool_size': 100}
         driver = Biom2Neo(user=inputs['username'],
                           password=inputs['password'],
                           uri=inputs['address'], filepath=inputs['fp'],
@@ -377,6 +393,205 @@ class TestNeo4Biom(unittest.TestCase):
         driver.query("MATCH (n:) DETACH DELETE n")
         self.assertEqual(test[0]['count'], 6)
 
+    def test_create_obs_meta_dicts(self):
+        """
+        Checks if the taxonomy dictionaries are constructed
+        from a single pass over the observation metadata.
+        :return:
+        """
+        create_dict, connect_dict, add_dict, meta1, meta2 = Biom2Neo._create_obs_meta_dicts(testbiom)
+        self.assertEqual(len(create_dict['Genus']), 4)
+        self.assertEqual(len(create_dict['Species']), 1)
+        self.assertEqual(len(add_dict['Order']), 5)
+
+    def test_iter_obs_batches(self):
+        """
+        Checks if all nonzero observations are generated
+        in batches that do not exceed the batch size.
+        :return:
+        """
+        batches = list(Biom2Neo._iter_obs_batches(testbiom, batch_size=4))
+        self.assertEqual([len(x) for x in batches], [4, 4, 4, 3])
+        observations = {(x['taxon'], x['sample']): x['value'] for batch in batches for x in batch}
+        self.assertEqual(len(observations), 15)
+        for (taxon, sample), value in observations.items():
+            self.assertEqual(testbiom.get_value_by_ids(taxon, sample), value)
+
+    def test_cached_load_table(self):
+        """
+        Checks if a cached BIOM table is used when the file has not changed,
+        and if the file is read again when it has changed or the cache is corrupt.
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            biom_fp = tmp + '/cache_test.hdf5'
+            cache_dir = tmp + '/cache'
+            write_biom_table(testbiom, filepath=biom_fp, fmt='hdf5')
+            _cached_load_table(biom_fp, cache=True, cache_dir=cache_dir)
+            cache_file = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+            # unchanged file: the pickle is used
+            with mock.patch('mako.scripts.neo4biom.load_table') as load:
+                table = _cached_load_table(biom_fp, cache=True, cache_dir=cache_dir)
+                load.assert_not_called()
+            # the metadata is kept in the cached copy
+            self.assertEqual(table, testbiom)
+            # changed file: the BIOM file is read again
+            stat = os.stat(biom_fp)
+            os.utime(biom_fp, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+            with mock.patch('mako.scripts.neo4biom.load_table', return_value=testbiom) as load:
+                _cached_load_table(biom_fp, cache=True, cache_dir=cache_dir)
+                load.assert_called_once()
+            # corrupt cache: the BIOM file is read again
+            with open(cache_file, 'wb') as file:
+                file.write(b'not a pickle')
+            table = _cached_load_table(biom_fp, cache=True, cache_dir=cache_dir)
+            self.assertEqual(table.shape, testbiom.shape)
+            # a single pickle is kept per BIOM file
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_read_metadata(self):
+        """
+        Checks if comment lines are skipped and quotes and whitespace
+        are removed when a mapping file is read.
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            meta_fp = tmp + '/mapping.tsv'
+            with open(meta_fp, 'w') as file:
+                file.write('#SampleID\tBODY_SITE\tDescription\n'
+                           '#a comment line\n'
+                           '\n'
+                           'S1\t"gut"\t human gut \n'
+                           'S2\tskin\n'
+                           '\tlung\tno sample name\n')
+            metadata = _read_metadata(meta_fp)
+        # an empty first cell does not shift the other values
+        self.assertEqual(metadata, {'S1': {'BODY_SITE': 'gut', 'Description': 'human gut'},
+                                    'S2': {'BODY_SITE': 'skin', 'Description': ''},
+                                    '': {'BODY_SITE': 'lung', 'Description': 'no sample name'}})
+
+    def test_convert_biom_csv(self):
+        """
+        Exports the test BIOM file to CSV files for neo4j-admin import
+        and checks the headers, the number of rows
+        and the returned import command.
+        :return:
+        """
+        driver = Biom2Neo(user='neo4j',
+                          password='test',
+                          uri='bolt://localhost:7688', filepath=_resource_path(''),
+                          encrypted=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            command = driver.convert_biom_csv(testbiom, 'test', tmp)
+            taxa = pd.read_csv(tmp + '/test_taxa.csv')
+            specimens = pd.read_csv(tmp + '/test_specimens.csv')
+            part_of = pd.read_csv(tmp + '/test_part_of.csv')
+            located_in = pd.read_csv(tmp + '/test_located_in.csv')
+            command_no_obs = driver.convert_biom_csv(testbiom, 'test_no_obs', tmp, obs=False)
+        driver.close()
+        self.assertEqual(list(taxa.columns), ['name:ID(Taxon)', ':LABEL'])
+        self.assertEqual(len(taxa), 5)
+        self.assertEqual(list(specimens.columns), ['name:ID(Specimen)', ':LABEL'])
+        self.assertEqual(len(specimens), 6)
+        self.assertEqual(list(part_of.columns), [':START_ID(Specimen)', ':END_ID(Experiment)', ':TYPE'])
+        self.assertEqual(len(part_of), 6)
+        self.assertEqual(list(located_in.columns),
+                         [':START_ID(Taxon)', ':END_ID(Specimen)', 'count:float', ':TYPE'])
+        self.assertEqual(len(located_in), 15)
+        self.assertTrue(command.startswith('neo4j-admin import --skip-duplicate-nodes=true'))
+        self.assertIn('--nodes=' + tmp + '/test_taxa.csv', command)
+        self.assertIn('--relationships=' + tmp + '/test_located_in.csv', command)
+        self.assertNotIn('located_in.csv', command_no_obs)
+
+    def test_convert_biom_csv_unclassified(self):
+        """
+        Checks if taxa with an unclassified upper level
+        are not connected to a taxonomy node that is missing from the node files.
+        :return:
+        """
+        unclassified = biom.Table(np.array([[1, 2], [3, 0]]), ['O1', 'O2'], ['S1', 'S2'],
+                                  observation_metadata=[{'taxonomy': ['k__Bacteria', 'p__Firmicutes',
+                                                                      'c__Clostridia']},
+                                                        {'taxonomy': ['k__Bacteria', 'p__',
+                                                                      'c__Bacilli']}])
+        driver = Biom2Neo(user='neo4j',
+                          password='test',
+                          uri='bolt://localhost:7688', filepath=_resource_path(''),
+                          encrypted=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            driver.convert_biom_csv(unclassified, 'test', tmp)
+            phyla = pd.read_csv(tmp + '/test_Phylum.csv')
+            member_of = pd.read_csv(tmp + '/test_Class_member_of.csv')
+        driver.close()
+        self.assertEqual(list(phyla['name:ID(Phylum)']), ['p__Firmicutes'])
+        self.assertEqual(list(member_of[':START_ID(Class)']), ['c__Clostridia'])
+        self.assertTrue(member_of[':END_ID(Phylum)'].isin(phyla['name:ID(Phylum)']).all())
+
+    def test_start_biom_bulk(self):
+        """
+        Checks if writing more than one file for neo4j-admin import is rejected,
+        since every import needs an empty database.
+        :return:
+        """
+        inputs = {'biom_file': [_resource_path('test.hdf5'), _resource_path('test.hdf5')],
+                  'fp': _resource_path(''),
+                  'count_table': None,
+                  'tax_table': None,
+                  'sample_meta': None,
+                  'taxon_meta': None,
+                  'qza': None,
+                  'username': 'neo4j',
+                  'password': 'test',
+                  'address': 'bolt://localhost:7688',
+                  'store_config': False,
+                  'delete': None,
+                  'encryption': False,
+                  'obs': True,
+                  'bulk': True,
+                  'workers': 1,
+                  'pool_size': 100}
+        with self.assertRaises(SystemExit):
+            start_biom(inputs)
+        self.assertFalse(os.path.isfile(_resource_path('test_taxa.csv')))
+
+    def test_create_constraints_restores_index(self):
+        """
+        Checks if the index on names is created again
+        when the unique constraint replacing it cannot be created.
+        :return:
+        """
+        driver = Biom2Neo(user='neo4j',
+                          password='test',
+                          uri='bolt://localhost:7688', filepath=_resource_path(''),
+                          encrypted=False)
+        driver.close()
+        session = mock.MagicMock()
+        driver._driver = mock.MagicMock()
+        driver._driver.session.return_value.__enter__.return_value = session
+        session.read_transaction.side_effect = [['Taxon'], ['index_taxon'], ['Taxon']]
+
+        def write(func, *args):
+            if func == driver._query and args[0].startswith('CREATE CONSTRAINT'):
+                raise ValueError('Duplicate names')
+        session.write_transaction.side_effect = write
+        self.assertFalse(driver.create_constraints())
+        session.write_transaction.assert_any_call(driver._query, "DROP INDEX `index_taxon` IF EXISTS")
+        session.write_transaction.assert_called_with(_create_name_indices, ['Taxon'])
+
+    def test_retry_transient_cleanup(self):
+        """
+        Checks if observations committed by a failed attempt
+        are deleted before the upload is retried.
+        :return:
+        """
+        session = mock.Mock()
+        observations = [{'taxon': 'GG_OTU_1', 'sample': 'Sample1', 'value': 1.0}]
+        create = mock.Mock(side_effect=[TransientError('Deadlock detected'), None])
+        cleanup = mock.Mock()
+        Biom2Neo._retry_transient(create, session, observations, cleanup=cleanup)
+        self.assertEqual(create.call_count, 2)
+        cleanup.assert_called_once_with(session, observations)
+
 
 if __name__ == '__main__':
     unittest.main()
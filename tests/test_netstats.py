@@ -8,11 +8,12 @@ The file first sets up a simple Neo4j database for carrying out the tests.
 import unittest
 import time
 import os
+from unittest import mock
 import biom
 import networkx as nx
 from mako.scripts.neo4biom import Biom2Neo
 from mako.scripts.io import IoDriver
-from mako.scripts.netstats import start_netstats, NetstatsDriver
+from mako.scripts.netstats import start_netstats, NetstatsDriver, _curate_weighted_edges
 from mako.scripts.utils import _resource_path
 
 __author__ = 'Lisa Rottjers'
@@ -323,6 +324,76 @@ class TestNetstats(unittest.TestCase):
         self.assertEqual(test[0]['a']['name'], 'Intersection_weight_2')
 
 
+    def test_get_union(self):
+        """
+        Checks if the union returns each edge once
+        and passes the network names as query parameter.
+        :return:
+        """
+        tx = mock.MagicMock()
+        tx.run.return_value.value.return_value = ['edge1', 'edge2']
+        edges = NetstatsDriver._get_union(tx, ['f', 'g'])
+        self.assertEqual(edges, {'edge1', 'edge2'})
+        self.assertEqual(tx.run.call_args.kwargs['names'], ['f', 'g'])
+
+    def test_get_intersection_fraction(self):
+        """
+        Checks if the intersection for a number of networks
+        runs a single query when weights should match.
+        :return:
+        """
+        tx = mock.MagicMock()
+        tx.run.return_value.value.return_value = ['edge1', 'edge2']
+        edges = NetstatsDriver._get_intersection(tx, ['f', 'g'], weight=True, n=2)
+        self.assertEqual(edges, ['edge1', 'edge2'])
+        self.assertEqual(tx.run.call_count, 1)
+        self.assertEqual(tx.run.call_args.kwargs['n'], 2)
+
+    def test_get_intersection_weight(self):
+        """
+        Checks if edges with matching partners but different weights
+        are added to the intersection after curation.
+        :return:
+        """
+        tx = mock.MagicMock()
+        tx.run.return_value.value.return_value = ['edge1']
+        tx.run.return_value.__iter__.return_value = iter([{'name': 'edge3'}])
+        with mock.patch('mako.scripts.netstats._curate_weighted_edges',
+                        return_value={'edge3'}) as curate:
+            edges = NetstatsDriver._get_intersection(tx, ['f', 'g'], weight=False, n=2)
+        curate.assert_called_once_with(tx, {'edge3'}, ['f', 'g'])
+        self.assertEqual(edges, ['edge1', 'edge3'])
+
+    def test_get_difference_weight(self):
+        """
+        Checks if edges with different weights are removed
+        from the weighted difference by the database query.
+        :return:
+        """
+        tx = mock.MagicMock()
+        tx.run.return_value.value.return_value = ['edge2']
+        tx.run.return_value.__iter__.return_value = iter([{'name': 'edge1'}])
+        with mock.patch('mako.scripts.netstats._curate_weighted_edges',
+                        return_value={'edge1'}):
+            edges = NetstatsDriver._get_difference(tx, ['f', 'g'], weight=True)
+        self.assertEqual(edges, {'edge2'})
+        self.assertEqual(tx.run.call_args.kwargs['removed'], ['edge1'])
+
+    def test_curate_weighted_edges(self):
+        """
+        Checks if weighted edges are only returned
+        when the paired edges cover all networks.
+        :return:
+        """
+        tx = mock.MagicMock()
+        tx.run.return_value.single.return_value = {'curated': True}
+        self.assertEqual(_curate_weighted_edges(tx, {'edge1', 'edge2'}, ['f', 'g']), {'edge1', 'edge2'})
+        self.assertEqual(tx.run.call_args.kwargs['networks'], ['f', 'g'])
+        tx.run.return_value.single.return_value = {'curated': False}
+        self.assertEqual(_curate_weighted_edges(tx, {'edge1', 'edge2'}, ['f', 'g']), set())
+        tx.run.return_value.single.return_value = None
+        self.assertEqual(_curate_weighted_edges(tx, {'edge1', 'edge2'}, ['f', 'g']), set())
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -8,11 +8,14 @@ The file first sets up a simple Neo4j database for carrying out the tests.
 import unittest
 import time
 import os
+import tempfile
+from unittest import mock
 import biom
 import networkx as nx
 from mako.scripts.neo4biom import Biom2Neo
 from mako.scripts.io import IoDriver
-from mako.scripts.utils import _resource_path, _get_unique, _read_config, _get_path, ParentDriver
+from mako.scripts.utils import _resource_path, _get_unique, _read_config, _get_path, ParentDriver, \
+    _load_config, MakoDriverError
 
 __author__ = 'Lisa Rottjers'
 __maintainer__ = 'Lisa Rottjers'
@@ -180,6 +183,48 @@ class TestUtils(unittest.TestCase):
                                'fp': os.getcwd()})
         self.assertEqual(len(config), 5)
 
+    def test_read_config_cache(self):
+        """
+        Checks if an unchanged config file is parsed and written only once,
+        and if a rewritten config file is read again.
+        :return:
+        """
+        _load_config.cache_clear()
+        with tempfile.TemporaryDirectory() as tmp:
+            args = {'store_config': True, 'fp': tmp,
+                    'address': 'bolt://localhost:7688',
+                    'username': 'neo4j', 'password': 'test'}
+            _read_config(args)
+            with mock.patch('mako.scripts.utils._write_config') as write:
+                _read_config(args)
+                config = _read_config(args)
+                write.assert_not_called()
+            self.assertEqual(config['password'], 'test')
+            self.assertEqual(_load_config.cache_info().hits, 1)
+            args['password'] = 'new'
+            _read_config(args)
+            config = _read_config({'store_config': True, 'fp': tmp})
+            self.assertEqual(config['password'], 'new')
+
+    def test_write_config(self):
+        """
+        Checks if the config file is replaced in full
+        and no temporary files are left behind.
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            args = {'store_config': True, 'fp': tmp,
+                    'address': 'bolt://localhost:7688',
+                    'username': 'neo4j', 'password': 'test'}
+            _read_config(args)
+            args['store_config'] = False
+            _read_config(args)
+            self.assertEqual(os.listdir(tmp), ['config'])
+            with open(tmp + '/config', 'r') as file:
+                lines = file.readlines()
+            self.assertEqual(len(lines), 6)
+            self.assertEqual(lines[-1], 'username: None\n')
+
     def test_get_path(self):
         """
         Checks if the path function returns the complete file path.
@@ -211,6 +256,18 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(len(test), 1)
 
 
+    def test_ParentDriver_error(self):
+        """
+        Checks if a MakoDriverError is raised when the driver cannot be started.
+        :return:
+        """
+        with mock.patch('mako.scripts.utils.GraphDatabase.driver', side_effect=ValueError('Invalid URI')):
+            with self.assertRaises(MakoDriverError):
+                ParentDriver(user='neo4j',
+                             password='test',
+                             uri='localhost:7688', filepath=_resource_path(''),
+                             encrypted=False)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -8,11 +8,14 @@ The file first sets up a simple Neo4j database for carrying out the tests.
 import unittest
 import time
 import os
+import logging.handlers
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 import biom
 import networkx as nx
 from mako.scripts.neo4biom import Biom2Neo
 from mako.scripts.io import IoDriver
-from mako.scripts.wrapper import start_wrapper
+from mako.scripts.wrapper import start_wrapper, _run_manta_worker, _include_attribute
 from mako.scripts.utils import _resource_path, _get_unique
 
 __author__ = 'Lisa Rottjers'
@@ -414,6 +417,57 @@ class TestWrapper(unittest.TestCase):
         self.assertEqual(max(len(cluster0), len(cluster1)), 3)
 
 
+    def test_run_manta_worker(self):
+        """
+        Checks if a manta worker opens its own driver
+        and discards log records buffered by the parent process.
+        :return:
+        """
+        target = mock.Mock()
+        handler = logging.handlers.MemoryHandler(capacity=1024, flushLevel=logging.CRITICAL, target=target)
+        utils_logger = logging.getLogger('mako.scripts.utils')
+        utils_logger.addHandler(handler)
+        try:
+            utils_logger.warning('Record buffered by the parent process')
+            self.assertEqual(len(handler.buffer), 1)
+            login = {'address': 'bolt://localhost:7688', 'username': 'neo4j', 'password': 'test'}
+            inputs = {'fp': _resource_path(''), 'encryption': False}
+            with mock.patch('mako.scripts.wrapper.IoDriver') as driver, \
+                    mock.patch('mako.scripts.wrapper.run_manta') as manta:
+                _run_manta_worker(inputs, login, g, 'g')
+            driver.assert_called_once_with(uri='bolt://localhost:7688', user='neo4j',
+                                           password='test', filepath=_resource_path(''),
+                                           encrypted=False)
+            manta.assert_called_once_with(inputs, network=g, network_id='g',
+                                          driver=driver.return_value.__enter__.return_value)
+            self.assertEqual(len(handler.buffer), 0)
+            target.handle.assert_not_called()
+        finally:
+            utils_logger.removeHandler(handler)
+
+    def test_include_attribute(self):
+        """
+        Checks if manta results are uploaded directly without an uploader,
+        submitted to the uploader otherwise,
+        and skipped if no node has the attribute.
+        :return:
+        """
+        graph = nx.Graph()
+        graph.add_nodes_from([('GG_OTU_1', {'cluster': 0}), ('GG_OTU_2', {'cluster': 1})])
+        records = [{'source': 'GG_OTU_1', 'target': 'g, cluster 0'},
+                   {'source': 'GG_OTU_2', 'target': 'g, cluster 1'}]
+        driver = mock.Mock()
+        self.assertIsNone(_include_attribute(graph, 'cluster', 'Cluster', 'g', driver))
+        driver.include_nodes.assert_called_once_with(records, name='Cluster', label='Taxon', verbose=False)
+        driver.reset_mock()
+        with ThreadPoolExecutor(max_workers=1) as uploader:
+            upload = _include_attribute(graph, 'cluster', 'Cluster', 'g', driver, uploader)
+            # the records are built before the upload starts
+            graph.nodes['GG_OTU_1']['cluster'] = 2
+            upload.result()
+            self.assertIsNone(_include_attribute(graph, 'assignment', 'Cluster', 'g', driver, uploader))
+        driver.include_nodes.assert_called_once_with(records, name='Cluster', label='Taxon', verbose=False)
+
 if __name__ == '__main__':
     unittest.main()
 